@@ -0,0 +1,2 @@
+# Offline benchmarks for restream.py (not shipped in the Docker image).
+#   python -m bench.run --sizes 1000,10000,50000 --out bench.json
@@ -0,0 +1,333 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# ============================================================
+# End-to-end load harness for the 240p restream path
+#   python -m bench.load --viewers 1,4,16,32 --channels 2 --duration 30 --out load.json
+# Everything runs on this box: ffmpeg lavfi test sources are packaged
+# as HLS (MPEG-TS segments), served over local HTTP, and N clients pull
+# /play-240p-direct from an in-process restream server.
+# ============================================================
+os.environ.setdefault("PROBE_ENABLED", "0")
+os.environ.setdefault("PLAYLIST_STORE_DIR", tempfile.mkdtemp(prefix="restream-load-"))
+
+TS_PACKET = 188
+STALL_GAP = 2.0          # seconds without bytes counts as a stall
+REALTIME_MIN = 0.95      # media seconds per wall second a viewer needs to keep up
+REALTIME_WARMUP = 2.0    # one GOP: joiners get the cached GOP at once, so the clocks start after it
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+# ------------------------------------------------------------
+# Origin: lavfi test pattern -> HLS on disk -> local HTTP
+# ------------------------------------------------------------
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class Origin:
+    def __init__(self, channels: int, root: str):
+        self.root = root
+        self.channels = channels
+        self.procs = []
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), partial(_QuietHandler, directory=root))
+        self.httpd.daemon_threads = True
+
+    def url(self, i: int) -> str:
+        return "http://127.0.0.1:%d/ch%d/index.m3u8" % (self.httpd.server_address[1], i)
+
+    def start(self, timeout=30):
+        for i in range(self.channels):
+            out = os.path.join(self.root, f"ch{i}")
+            os.makedirs(out, exist_ok=True)
+            # distinct pattern/tone per channel so each one really is a separate source
+            self.procs.append(subprocess.Popen([
+                "ffmpeg", "-loglevel", "error", "-re",
+                "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=25,hue=h={i * 37 % 360}",
+                "-f", "lavfi", "-i", f"sine=frequency={440 + 110 * i}:sample_rate=48000",
+                "-c:v", "libx264", "-preset", "veryfast", "-b:v", "2500k", "-g", "50",
+                "-c:a", "aac", "-b:a", "128k",
+                "-f", "hls", "-hls_time", "2", "-hls_list_size", "6",
+                "-hls_flags", "delete_segments+temp_file",
+                os.path.join(out, "index.m3u8"),
+            ], stdin=subprocess.DEVNULL))
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        deadline = time.time() + timeout
+        for i in range(self.channels):
+            playlist = os.path.join(self.root, f"ch{i}", "index.m3u8")
+            while not os.path.exists(playlist):
+                if time.time() > deadline:
+                    raise RuntimeError("origin ffmpeg did not produce " + playlist)
+                time.sleep(0.2)
+
+    def stop(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# ------------------------------------------------------------
+# Restream under test, served in-process with werkzeug
+# ------------------------------------------------------------
+def start_app():
+    from werkzeug.serving import make_server
+    import restream
+    restream.logging.getLogger().setLevel(restream.logging.WARNING)
+    server = make_server("127.0.0.1", 0, restream.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d" % server.server_port
+
+# ------------------------------------------------------------
+# Viewer: reads the stream, tracks TTFB, stalls and media clock (PCR)
+# ------------------------------------------------------------
+def pcr_seconds(packet: bytes):
+    # 27 MHz PCR from the adaptation field, in seconds; None when absent
+    if packet[0] != 0x47 or not packet[3] & 0x20 or packet[4] < 7 or not packet[5] & 0x10:
+        return None
+    base = (packet[6] << 25) | (packet[7] << 17) | (packet[8] << 9) | (packet[9] << 1) | (packet[10] >> 7)
+    ext = ((packet[10] & 1) << 8) | packet[11]
+    return (base * 300 + ext) / 27e6
+
+class Viewer(threading.Thread):
+    def __init__(self, url: str, duration: float):
+        super().__init__(daemon=True)
+        self.url = url
+        self.duration = duration
+        self.status = None
+        self.ttfb = None
+        self.bytes = 0
+        self.stalls = 0
+        self.dropped = False
+        self.error = None
+        self.first_at = None
+        self.last_at = None
+        # media clock: from the first PCR past the warm-up burst to the last one, with their arrival times
+        self.first_pcr = self.first_pcr_at = None
+        self.last_pcr = self.last_pcr_at = None
+
+    def run(self):
+        import requests
+        started = time.time()
+        pending = b""
+        try:
+            with requests.get(self.url, stream=True, timeout=(5, STALL_GAP * 5)) as resp:
+                self.status = resp.status_code
+                if resp.status_code != 200:
+                    return
+                last = None
+                for chunk in resp.iter_content(64 * 1024):
+                    now = time.time()
+                    if self.ttfb is None:
+                        self.ttfb = now - started
+                        self.first_at = now
+                    elif now - last > STALL_GAP:
+                        self.stalls += 1
+                    last = self.last_at = now
+                    self.bytes += len(chunk)
+                    pending += chunk
+                    cut = len(pending) - len(pending) % TS_PACKET
+                    for off in range(0, cut, TS_PACKET):
+                        pcr = pcr_seconds(pending[off:off + TS_PACKET])
+                        if pcr is None or now - self.first_at < REALTIME_WARMUP:
+                            continue
+                        if self.first_pcr is None:
+                            self.first_pcr, self.first_pcr_at = pcr, now
+                        self.last_pcr, self.last_pcr_at = pcr, now
+                    pending = pending[cut:]
+                    if now - started >= self.duration:
+                        return
+                # the server closed the stream before the run ended
+                self.dropped = True
+        except Exception as e:
+            self.error = str(e)
+            self.dropped = True
+
+    def summary(self):
+        wall = (self.last_at - self.first_at) if self.first_at and self.last_at else 0
+        clock = (self.last_pcr_at - self.first_pcr_at) if self.first_pcr is not None else 0
+        media = (self.last_pcr - self.first_pcr) if self.first_pcr is not None else 0
+        if media < 0:
+            media += (1 << 33) / 90000.0      # PCR wrapped
+        return {
+            "status": self.status,
+            "ttfb_s": round(self.ttfb, 3) if self.ttfb is not None else None,
+            "kbps": round(self.bytes * 8 / 1000 / wall, 1) if wall else 0,
+            "realtime_ratio": round(media / clock, 3) if clock else 0,
+            "stalls": self.stalls,
+            "dropped": self.dropped,
+            "error": self.error,
+        }
+
+# ------------------------------------------------------------
+# Process accounting from /proc (the app process + its ffmpeg children)
+# ------------------------------------------------------------
+def _proc_sample(pid: int):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(l.split()[1]) for l in f if l.startswith("VmRSS:"))
+        return int(fields[11]) + int(fields[12]), rss * 1024   # utime+stime ticks, bytes
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None
+
+def _ffmpeg_children():
+    me = os.getpid()
+    out = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                data = f.read()
+        except OSError:
+            continue
+        name = data[data.find("(") + 1:data.rfind(")")]
+        ppid = int(data.rsplit(")", 1)[1].split()[1])
+        if ppid == me and name == "ffmpeg":
+            out.append(int(entry))
+    return out
+
+class ProcSampler(threading.Thread):
+    def __init__(self, exclude=(), interval=1.0):
+        super().__init__(daemon=True)
+        self.exclude = set(exclude)
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.first = {}
+        self.last = {}
+        self.peak_rss = 0
+        self.started = self.ended = None
+
+    def run(self):
+        self.started = time.time()
+        while not self.stop_event.is_set():
+            total_rss = 0
+            for pid in [os.getpid()] + [p for p in _ffmpeg_children() if p not in self.exclude]:
+                sample = _proc_sample(pid)
+                if sample is None:
+                    continue
+                self.first.setdefault(pid, sample[0])
+                self.last[pid] = sample[0]
+                total_rss += sample[1]
+            self.peak_rss = max(self.peak_rss, total_rss)
+            self.stop_event.wait(self.interval)
+        self.ended = time.time()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        ticks = sum(self.last[p] - self.first[p] for p in self.last)
+        wall = max(self.ended - self.started, 1e-6)
+        return {"cpu_cores": round(ticks / CLK_TCK / wall, 3), "peak_rss_bytes": self.peak_rss}
+
+# ------------------------------------------------------------
+# Driver
+# ------------------------------------------------------------
+def run_step(app_url: str, origin: Origin, viewers: int, duration: float, origin_pids):
+    from urllib.parse import quote
+    import restream
+    sampler = ProcSampler(exclude=origin_pids)
+    sampler.start()
+    clients = []
+    for i in range(viewers):
+        src = origin.url(i % origin.channels)
+        clients.append(Viewer(f"{app_url}/play-240p-direct?u={quote(src, safe='')}", duration))
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join(duration + 30)
+    usage = sampler.stop()
+    per = [c.summary() for c in clients]
+    ok = [p for p in per if p["status"] == 200]
+    ttfbs = sorted(p["ttfb_s"] for p in ok if p["ttfb_s"] is not None)
+    realtime = [p for p in ok if p["realtime_ratio"] >= REALTIME_MIN and not p["dropped"]]
+    return {
+        "viewers": viewers,
+        "sessions": restream.TRANSCODES.active_count(),
+        "rejected_503": sum(1 for p in per if p["status"] == 503),
+        "dropped": sum(1 for p in per if p["dropped"]),
+        "stalled": sum(1 for p in per if p["stalls"]),
+        "realtime_viewers": len(realtime),
+        "ttfb_p50_s": ttfbs[len(ttfbs) // 2] if ttfbs else None,
+        "ttfb_max_s": ttfbs[-1] if ttfbs else None,
+        "kbps_mean": round(sum(p["kbps"] for p in ok) / len(ok), 1) if ok else 0,
+        "cpu_cores": usage["cpu_cores"],
+        "cpu_cores_per_viewer": round(usage["cpu_cores"] / viewers, 4),
+        "peak_rss_bytes": usage["peak_rss_bytes"],
+        "rss_bytes_per_viewer": usage["peak_rss_bytes"] // viewers,
+        "clients": per,
+    }
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="240p restream load test (offline, Linux)")
+    ap.add_argument("--viewers", default="1,2,4,8,16", help="comma separated viewer counts to ramp through")
+    ap.add_argument("--channels", type=int, default=1,
+                    help="distinct origin streams; viewers are spread round-robin (1 = pure fan-out)")
+    ap.add_argument("--duration", type=float, default=20, help="seconds per step")
+    ap.add_argument("--settle", type=float, default=5, help="pause between steps so sessions are reaped")
+    ap.add_argument("--out", default="-")
+    args = ap.parse_args(argv)
+
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg not found on PATH")
+
+    root = tempfile.mkdtemp(prefix="restream-origin-")
+    origin = Origin(args.channels, root)
+    print(f"[load] starting {args.channels} origin stream(s)", file=sys.stderr)
+    origin.start()
+    origin_pids = [p.pid for p in origin.procs]
+    server, app_url = start_app()
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "cpus": os.cpu_count(),
+            "channels": args.channels,
+            "duration": args.duration,
+            "realtime_min": REALTIME_MIN,
+            "realtime_warmup_s": REALTIME_WARMUP,
+            "cpu_note": "restream's ffmpeg children plus this process (server and viewer threads)",
+        },
+        "steps": [],
+        "max_realtime_viewers": 0,
+    }
+    try:
+        for n in [int(v) for v in args.viewers.split(",") if v]:
+            print(f"[load] {n} viewers for {args.duration:.0f}s", file=sys.stderr)
+            step = run_step(app_url, origin, n, args.duration, origin_pids)
+            report["steps"].append(step)
+            print("[load]   realtime %d/%d, ttfb p50 %s, cpu %.2f cores"
+                  % (step["realtime_viewers"], n, step["ttfb_p50_s"], step["cpu_cores"]), file=sys.stderr)
+            if step["realtime_viewers"] == n:
+                report["max_realtime_viewers"] = n
+            else:
+                break
+            time.sleep(args.settle)
+    finally:
+        server.shutdown()
+        origin.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+    data = json.dumps(report, indent=2)
+    if args.out == "-":
+        print(data)
+    else:
+        with open(args.out, "w") as f:
+            f.write(data + "\n")
+        print(f"[load] wrote {args.out}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# keep the benchmark offline and self-contained
+os.environ.setdefault("PROBE_ENABLED", "0")
+os.environ.setdefault("PLAYLIST_STORE_DIR", tempfile.mkdtemp(prefix="restream-bench-"))
+
+import restream
+from bench.stub import StubServer
+from bench.synth import generate_m3u
+
+SEARCH_QUERIES = {
+    "one_char": "a",
+    "two_char": "zo",
+    "word": "news",
+    "word_prefix": "jaz",
+    "mid_word": "azee",
+    "multi_word": "star sports",
+    "group": "documentary",
+    "no_match": "qqqxz",
+}
+
+def timed(fn, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return {
+        "min_ms": round(min(samples) * 1000, 4),
+        "median_ms": round(statistics.median(samples) * 1000, 4),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 4),
+        "runs": repeat,
+    }
+
+def bench_parse(text: str, repeat: int):
+    n = len(restream.parse_m3u(text))
+    stats = timed(lambda: restream.parse_m3u(text), repeat)
+    stats["channels"] = n
+    stats["channels_per_s"] = round(n / (stats["median_ms"] / 1000))
+    stats["mb_per_s"] = round(len(text.encode()) / 1e6 / (stats["median_ms"] / 1000), 2)
+    lines = text.splitlines()
+    stats["collect"] = timed(lambda: restream.CHANNELS.collect(restream.iter_m3u(lines)), repeat)
+    return stats
+
+def _drop_store(name: str):
+    for path in restream._store_paths(name):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def bench_get_channels(name: str, repeat: int):
+    def cold():
+        restream.CACHE.pop(name, None)
+        _drop_store(name)
+        restream.get_channels(name)
+
+    def from_disk():
+        restream.CACHE.pop(name, None)
+        restream.get_channels(name)
+
+    def from_body():
+        # disk load without the parsed snapshot: what a restart cost before snapshots
+        restream.CACHE.pop(name, None)
+        try:
+            os.remove(restream._store_paths(name)[2])
+        except OSError:
+            pass
+        restream.get_channels(name)
+
+    def revalidate():
+        with restream._refresh_lock(name):
+            restream.refresh_playlist(name)
+
+    results = {"cold": timed(cold, repeat), "disk": timed(from_disk, repeat)}
+    results["disk_no_snapshot"] = timed(from_body, repeat)
+    results["revalidate_304"] = timed(revalidate, repeat)
+    results["warm"] = timed(lambda: restream.get_channels(name), repeat * 100)
+    return results
+
+def bench_search(channels, repeat: int):
+    started = time.perf_counter()
+    index = restream.SearchIndex(channels)
+    results = {"build_ms": round((time.perf_counter() - started) * 1000, 2)}
+    for shape, query in SEARCH_QUERIES.items():
+        stats = timed(lambda: index.search(query), repeat * 10)
+        stats["hits"] = len(index.search(query))
+        results[shape] = stats
+    return results
+
+def bench_render(name: str, repeat: int):
+    client = restream.app.test_client()
+    url = f"/list/{name}"
+
+    def miss():
+        restream.RENDER_CACHE.clear()
+        client.get(url)
+
+    etag = client.get(url).headers["ETag"]
+    return {
+        "page_miss": timed(miss, repeat),
+        "page_hit_gzip": timed(lambda: client.get(url, headers={"Accept-Encoding": "gzip"}), repeat * 10),
+        "page_304": timed(lambda: client.get(url, headers={"If-None-Match": etag}), repeat * 10),
+        "all_streamed": timed(lambda: client.get(url + "?limit=0").data, max(1, repeat // 2)),
+        "page_bytes": len(client.get(url).data),
+        "all_bytes": len(client.get(url + "?limit=0").data),
+    }
+
+def _git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="restream.py parse/cache/search/render benchmarks")
+    ap.add_argument("--sizes", default="1000,10000,50000",
+                    help="comma separated channel counts (1k..200k)")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--out", default="-", help="JSON output path ('-' for stdout)")
+    args = ap.parse_args(argv)
+
+    restream.logging.getLogger().setLevel(restream.logging.WARNING)
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    report = {
+        "meta": {
+            "git": _git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "runs": [],
+    }
+    with StubServer() as stub:
+        for size in sizes:
+            text = generate_m3u(size, args.seed)
+            name = f"bench{size}"
+            restream.PLAYLISTS[name] = stub.put(f"/{name}.m3u", text)
+            print(f"[bench] {size} channels, {len(text) / 1e6:.1f} MB", file=sys.stderr)
+            run = {"size": size, "bytes": len(text.encode())}
+            run["parse"] = bench_parse(text, args.repeat)
+            run["get_channels"] = bench_get_channels(name, args.repeat)
+            run["search"] = bench_search(restream.get_channels(name), args.repeat)
+            run["render"] = bench_render(name, args.repeat)
+            report["runs"].append(run)
+
+    data = json.dumps(report, indent=2)
+    if args.out == "-":
+        print(data)
+    else:
+        with open(args.out, "w") as f:
+            f.write(data + "\n")
+        print(f"[bench] wrote {args.out}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import random
+
+# ============================================================
+# Synthetic iptv-org style playlists
+# ============================================================
+CATEGORIES = ["News", "Sports", "Movies", "Music", "Kids", "Entertainment",
+              "Religious", "Documentary", "Undefined", "News;Entertainment"]
+COUNTRIES = ["in", "us", "uk", "ae", "sa", "pk", "ir", "fr", "de", "tr", "ru", "cn", "jp", "kr", "vn"]
+WORDS = ["Star", "Zee", "Sony", "Asia", "Al", "Jazeera", "BBC", "CNN", "Sky", "Fox", "One", "Plus",
+         "Gold", "Max", "Cinema", "Music", "Kids", "News", "Sports", "Live", "World", "Channel",
+         "Malayalam", "Tamil", "Bangla", "Arabia", "TV", "HD", "24", "Radio"]
+LOGO_HOSTS = ["https://i.imgur.com/", "https://upload.wikimedia.org/wikipedia/commons/",
+              "https://raw.githubusercontent.com/tv-logo/tv-logos/main/", "https://i.ibb.co/"]
+STREAM_HOSTS = ["https://live.example-cdn.net", "http://stream.example.tv:8080",
+                "https://cdn%d.example-origin.com", "https://d%d.cloudfront.example.net"]
+
+def _name(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+def _url(rng, i):
+    host = rng.choice(STREAM_HOSTS)
+    if "%d" in host:
+        host = host % rng.randint(1, 40)
+    ext = rng.choice([".m3u8"] * 8 + [".ts", ".mp4"])
+    return f"{host}/live/{i:06d}/index{ext}"
+
+def entry(rng, i):
+    name = _name(rng)
+    cc = rng.choice(COUNTRIES)
+    tvg_id = f"{name.replace(' ', '')}.{cc}@{rng.choice(['SD', 'HD', 'Plus1'])}"
+    logo = rng.choice(LOGO_HOSTS) + f"{rng.getrandbits(40):010x}.png"
+    group = rng.choice(CATEGORIES)
+    quality = rng.choice(["", " (720p)", " (1080p)", " (480p) [Not 24/7]", " [Geo-blocked]"])
+    attrs = f'tvg-id="{tvg_id}" tvg-logo="{logo}" group-title="{group}"'
+    roll = rng.random()
+    if roll < 0.03:
+        # quoted comma inside an attribute value
+        attrs = f'tvg-id="{tvg_id}" tvg-name="{name}, Live" tvg-logo="{logo}" group-title="{group}"'
+    elif roll < 0.05:
+        attrs = f'tvg-id={tvg_id} tvg-logo="{logo}" group-title="{group}'   # unquoted / unterminated
+    lines = [f"#EXTINF:-1 {attrs},{name}{quality}"]
+    if rng.random() < 0.1:
+        lines.append('#EXTVLCOPT:http-user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64)')
+    if rng.random() < 0.05:
+        lines.append('#EXTVLCOPT:http-referrer=https://example.com/')
+    if rng.random() < 0.02:
+        return lines            # malformed: EXTINF without a URL
+    lines.append(_url(rng, i))
+    return lines
+
+def generate_m3u(n: int, seed: int = 42) -> str:
+    rng = random.Random(seed)
+    out = ['#EXTM3U x-tvg-url="https://iptv-org.github.io/epg/guides.xml"']
+    for i in range(n):
+        out.extend(entry(rng, i))
+        r = rng.random()
+        if r < 0.01:
+            out.append("")
+        elif r < 0.015:
+            out.append(_url(rng, n + i))     # stray URL with no EXTINF
+        elif r < 0.02:
+            out.append("#EXTGRP:Misc")
+    return "\r\n".join(out) + "\r\n"
@@ -1,11 +1,41 @@
 #!/usr/bin/env python3
 import os
+import sys
+import re
+import json
 import time
 import logging
 import random
 import requests
+import requests.adapters
 import subprocess
-from flask import Flask, Response, render_template_string, abort, stream_with_context, request
+import shutil
+import hashlib
+import hmac
+import tempfile
+import fcntl
+import gzip
+import sqlite3
+import marshal
+import importlib.util
+import threading
+import asyncio
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from bisect import bisect_left
+from itertools import count, islice
+from flask import Flask, Response, render_template, stream_template, abort, jsonify, redirect, stream_with_context, request, send_from_directory
+from urllib.parse import quote, urljoin, parse_qs
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# aiohttp (prober) and uvicorn/a2wsgi (--asgi) are slow to import; they load on first use
+aiohttp = None
+HAVE_AIOHTTP = importlib.util.find_spec("aiohttp") is not None
 
 # ============================================================
 # Basic Setup
@@ -71,6 +101,118 @@ PLAYLISTS = {
 }
 
 CACHE = {}
+PLAYLIST_VERSION = count(1)
+
+# ============================================================
+# Metrics (Prometheus text exposition, no external dependency)
+# ============================================================
+METRICS = []
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6, 1e9)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_str(names, values, le=None):
+    parts = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if le is not None:
+        parts.append('le="%s"' % le)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [f"{self.name}{_label_str(self.labels, k)} {v}" for k, v in items]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), read=None):
+        super().__init__(name, help, labels)
+        self.read = read          # optional callback evaluated at scrape time
+
+    def set(self, *labels, value):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.read is not None:
+            return [f"{self.name} {self.read()}"]
+        return super().samples()
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self.values = {}          # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            row = self.values.get(labels)
+            if row is None:
+                row = self.values[labels] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(k, list(v)) for k, v in self.values.items()]
+        out = []
+        for labels, row in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                out.append(f"{self.name}_bucket{_label_str(self.labels, labels, '%g' % bound)} {cumulative}")
+            out.append(f"{self.name}_bucket{_label_str(self.labels, labels, '+Inf')} {row[-1]}")
+            out.append(f"{self.name}_sum{_label_str(self.labels, labels)} {row[-2]}")
+            out.append(f"{self.name}_count{_label_str(self.labels, labels)} {row[-1]}")
+        return out
+
+def render_metrics() -> str:
+    lines = []
+    for m in METRICS:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.samples())
+    return "\n".join(lines) + "\n"
+
+PLAYLIST_FETCH_SECONDS = Histogram("restream_playlist_fetch_seconds", "Playlist download+parse time", ("playlist",))
+PLAYLIST_FETCH_BYTES = Counter("restream_playlist_fetch_bytes_total", "Playlist bytes downloaded", ("playlist",))
+PLAYLIST_FETCHES = Counter("restream_playlist_fetches_total", "Playlist fetches by outcome", ("playlist", "result"))
+PARSE_SECONDS = Histogram("restream_parse_seconds", "CPU time spent decoding and parsing M3U", ("playlist",))
+PLAYLIST_CHANNELS = Gauge("restream_playlist_channels", "Channels in the last parse", ("playlist",))
+CACHE_LOOKUPS = Counter("restream_cache_lookups_total", "get_channels lookups", ("result",))
+SEARCH_SECONDS = Histogram("restream_search_seconds", "/search index lookup time")
+RENDER_SECONDS = Histogram("restream_render_seconds", "Template render time", ("route",))
+TRANSCODE_FIRST_BYTE = Histogram("restream_transcode_first_byte_seconds", "ffmpeg spawn to first output byte", ("profile",))
+TRANSCODE_SESSION_BYTES = Histogram("restream_transcode_session_bytes", "Bytes relayed to viewers per session",
+                                    ("profile",), buckets=BYTES_BUCKETS)
+TRANSCODE_RELAYED = Counter("restream_transcode_relayed_bytes_total", "Bytes relayed to viewers", ("profile",))
+TRANSCODE_VIEWER_ENDS = Counter("restream_transcode_viewer_ends_total", "Viewer streams ended, by reason",
+                                ("profile", "reason"))
+TRANSCODE_SESSION_ENDS = Counter("restream_transcode_session_ends_total", "ffmpeg sessions ended, by reason",
+                                 ("profile", "reason"))
+TRANSCODE_RESTARTS = Counter("restream_transcode_restarts_total", "ffmpeg restarts by the session supervisor",
+                             ("profile", "reason"))
 
 # ============================================================
 # M3U PARSER
@@ -111,60 +253,1766 @@ def parse_extinf(line: str):
         attrs[key] = val
     return attrs, title.strip()
 
+def iter_m3u(lines):
+    # incremental parser: yields channels as lines arrive (same output as the old list-based loop)
+    pending = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if pending is None:
+            if line.startswith("#EXTINF"):
+                pending = parse_extinf(line)
+        elif not line.startswith("#"):
+            attrs, title = pending
+            pending = None
+            yield {
+                "title": title or attrs.get("tvg-name") or "Unknown",
+                "url": line,
+                "logo": attrs.get("tvg-logo") or "",
+                "group": attrs.get("group-title") or "",
+                "tvg_id": attrs.get("tvg-id") or "",
+            }
+
 def parse_m3u(text: str):
-    lines = [l.strip() for l in text.splitlines() if l.strip()]
-    channels = []
-    i = 0
-    while i < len(lines):
-        if lines[i].startswith("#EXTINF"):
-            attrs, title = parse_extinf(lines[i])
-            j = i + 1
-            url = None
-            while j < len(lines):
-                if not lines[j].startswith("#"):
-                    url = lines[j]
-                    break
-                j += 1
-            if url:
-                channels.append({
-                    "title": title or attrs.get("tvg-name") or "Unknown",
-                    "url": url,
-                    "logo": attrs.get("tvg-logo") or "",
-                    "group": attrs.get("group-title") or "",
-                    "tvg_id": attrs.get("tvg-id") or "",
-                })
-            i = j + 1
+    return list(iter_m3u(text.splitlines()))
+
+def iter_response_lines(resp, out=None):
+    # decode while downloading; optionally tee the raw body to a file
+    for raw in resp.iter_lines(chunk_size=64 * 1024):
+        if out is not None:
+            out.write(raw + b"\n")
+        yield raw.decode("utf-8", "replace")
+
+def _m3u_attr(value: str) -> str:
+    # M3U has no escaping: keep attribute values inside their quotes
+    return value.replace('"', "'").replace("\n", " ")
+
+def write_m3u(channels):
+    yield "#EXTM3U\n"
+    for ch in channels:
+        yield '#EXTINF:-1 tvg-id="%s" tvg-logo="%s" group-title="%s",%s\n%s\n' % (
+            _m3u_attr(ch.tvg_id), _m3u_attr(ch.logo), _m3u_attr(ch.group),
+            ch.title.replace("\n", " "), ch.url
+        )
+
+# ============================================================
+# Channel registry (one slotted record per distinct channel, shared by all playlists)
+# ============================================================
+def channel_id(url: str, tvg_id: str) -> str:
+    # derived from the registry key, so it survives refreshes that reorder a playlist
+    return hashlib.blake2b(f"{tvg_id}|{url}".encode(), digest_size=6).hexdigest()
+
+class Channel:
+    __slots__ = ("id", "title", "url", "group", "tvg_id", "logo_host", "logo_path")
+
+    def __init__(self, title, url, logo, group, tvg_id):
+        self.id = channel_id(url, tvg_id)
+        self.title = title
+        self.url = url
+        self.group = sys.intern(group)
+        self.tvg_id = sys.intern(tvg_id)
+        # logos mostly come from a handful of hosts; keep one copy of each prefix
+        cut = logo.find("/", logo.find("//") + 2) + 1 if "//" in logo else 0
+        self.logo_host = sys.intern(logo[:cut])
+        self.logo_path = logo[cut:]
+
+    @property
+    def logo(self):
+        return self.logo_host + self.logo_path
+
+    def fields(self):
+        return (self.title, self.url, self.logo, self.group, self.tvg_id)
+
+class ChannelRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.by_key = {}        # (url, tvg_id) -> id
+        self.variants = {}      # full field tuple -> id, when playlists disagree on the rest
+        self.by_tvg = {}        # tvg_id -> ids, for failing over between playlists' URLs
+        self.by_id = {}         # stable channel id -> id
+        self.free = []          # ids of swept records, reused by new ones
+        self.unreferenced = set()   # unlisted at the last sweep; freed if still unlisted at the next
+        self.swept = time.time()
+
+    def add(self, title, url, logo, group, tvg_id) -> int:
+        key = (url, tvg_id)
+        full = (title, url, logo, group, tvg_id)
+        with self.lock:
+            cid = self.by_key.get(key)
+            if cid is None:
+                cid = self.by_key[key] = self._append(full)
+                if tvg_id:
+                    self.by_tvg.setdefault(tvg_id, []).append(cid)
+            elif self.records[cid].fields() != full:
+                cid = self.variants.get(full)
+                if cid is None:
+                    cid = self.variants[full] = self._append(full)
+            # variants share one id; it resolves to whatever the latest parse listed (e.g. after a rename)
+            self.by_id[self.records[cid].id] = cid
+            self.unreferenced.discard(cid)      # a parse in progress is about to list it again
+            return cid
+
+    def _append(self, full) -> int:
+        ch = Channel(*full)
+        if self.free:
+            cid = self.free.pop()
+            self.records[cid] = ch
+            return cid
+        self.records.append(ch)
+        return len(self.records) - 1
+
+    def sweep_due(self) -> bool:
+        return time.time() - self.swept >= CHANNEL_SWEEP_INTERVAL
+
+    def sweep(self, live) -> int:
+        # free records no playlist has listed for two sweeps in a row; the gap covers
+        # requests still iterating a list that was replaced in between
+        with self.lock:
+            if not self.sweep_due():
+                return 0
+            self.swept = time.time()
+            dead = {cid for cid, ch in enumerate(self.records) if ch is not None and cid not in live}
+            doomed = dead & self.unreferenced
+            self.unreferenced = dead - doomed
+            if not doomed:
+                return 0
+            primaries = []
+            for cid in doomed:
+                ch = self.records[cid]
+                self.records[cid] = None
+                self.free.append(cid)
+                full = ch.fields()
+                if self.variants.get(full) == cid:
+                    del self.variants[full]
+                primaries.append((cid, ch))
+            survivors = {(full[1], full[4]): v for full, v in self.variants.items()}
+            for cid, ch in primaries:
+                key = (ch.url, ch.tvg_id)
+                if self.by_key.get(key) == cid:
+                    # a surviving variant becomes the record the key resolves to
+                    promoted = survivors.get(key)
+                    tvg = self.by_tvg.get(ch.tvg_id)
+                    if tvg is not None:
+                        tvg.remove(cid)
+                    if promoted is not None:
+                        del self.variants[self.records[promoted].fields()]
+                        self.by_key[key] = promoted
+                        if tvg is not None:
+                            tvg.append(promoted)
+                    else:
+                        del self.by_key[key]
+                    if tvg is not None and not tvg:
+                        del self.by_tvg[ch.tvg_id]
+            for cid, ch in primaries:
+                if self.by_id.get(ch.id) == cid:
+                    current = self.by_key.get((ch.url, ch.tvg_id))
+                    if current is None:
+                        del self.by_id[ch.id]
+                    else:
+                        self.by_id[ch.id] = current
+            return len(doomed)
+
+    def size(self) -> int:
+        return len(self.records) - len(self.free)
+
+    def get(self, channel_id: str):
+        cid = self.by_id.get(channel_id)
+        return None if cid is None else self.records[cid]
+
+    def has_url(self, url) -> bool:
+        with self.lock:
+            return any(u == url for u, _ in self.by_key)
+
+    def alternates(self, url, tvg_id=""):
+        # other URLs listed for the same channel (looked up from the URL when tvg_id is unknown)
+        with self.lock:
+            if not tvg_id:
+                tvg_id = next((t for u, t in self.by_key if u == url and t), "")
+            return [self.records[cid] for cid in self.by_tvg.get(tvg_id, ()) if self.records[cid].url != url]
+
+    def collect(self, channels):
+        # channel dicts (from iter_m3u) -> compact ChannelList
+        ids = array("I")
+        for ch in channels:
+            ids.append(self.add(ch["title"], ch["url"], ch["logo"], ch["group"], ch["tvg_id"]))
+        return ChannelList(ids)
+
+class ChannelList(Sequence):
+    __slots__ = ("ids",)
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ChannelList(self.ids[i])
+        return CHANNELS.records[self.ids[i]]
+
+    def __iter__(self):
+        records = CHANNELS.records
+        return (records[cid] for cid in self.ids)
+
+CHANNEL_SWEEP_INTERVAL = 300
+
+CHANNELS = ChannelRegistry()
+Gauge("restream_channel_records", "Distinct channel records held in memory", read=CHANNELS.size)
+
+def sweep_channels():
+    # refreshes replace lists; records only the old lists used are dropped from the registry
+    if not CHANNELS.sweep_due():
+        return
+    live = set()
+    for entry in list(CACHE.values()):
+        live.update(entry["channels"].ids)
+    freed = CHANNELS.sweep(live)
+    if freed:
+        logging.info("[channels] Freed %d unlisted records, %d left", freed, CHANNELS.size())
+
+# ============================================================
+# Search index (built once per parse, swapped in with the cache entry)
+# ============================================================
+SEARCH_INDEXED = {"all"}
+SEARCH_PREFIX_MAX = 2      # queries shorter than a trigram match word prefixes
+_WORD_RE = re.compile(r"\w+")
+
+def _trigrams(text: str):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class SearchIndex:
+    def __init__(self, channels):
+        self.channels = channels
+        self.titles = []
+        self.groups = []
+        grams = {}
+        prefixes = {}
+        for idx, ch in enumerate(channels):
+            title = ch.title.lower()
+            group = ch.group.lower()
+            self.titles.append(title)
+            self.groups.append(group)
+            for g in _trigrams(title) | _trigrams(group):
+                grams.setdefault(g, []).append(idx)
+            seen = set()
+            for word in _WORD_RE.findall(title + " " + group):
+                for n in range(1, min(len(word), SEARCH_PREFIX_MAX) + 1):
+                    if word[:n] not in seen:
+                        seen.add(word[:n])
+                        prefixes.setdefault(word[:n], []).append(idx)
+        self.grams = grams
+        self.prefixes = prefixes
+
+    def state(self):
+        # postings packed as uint32 bytes: marshal loads those far faster than int lists
+        pack = lambda postings: {k: array("I", p).tobytes() for k, p in postings.items()}
+        return self.titles, self.groups, pack(self.grams), pack(self.prefixes)
+
+    @classmethod
+    def restore(cls, channels, state):
+        # rebuild from a snapshot without re-tokenising every title
+        index = cls.__new__(cls)
+        index.channels = channels
+        index.titles, index.groups, grams, prefixes = state
+        index.grams = {k: memoryview(b).cast("I") for k, b in grams.items()}
+        index.prefixes = {k: memoryview(b).cast("I") for k, b in prefixes.items()}
+        return index
+
+    def _candidates(self, ql: str):
+        if len(ql) <= SEARCH_PREFIX_MAX:
+            return self.prefixes.get(ql, ())
+        postings = []
+        for g in _trigrams(ql):
+            p = self.grams.get(g)
+            if not p:
+                return ()
+            postings.append(p)
+        postings.sort(key=len)
+        cands = set(postings[0])
+        for p in postings[1:]:
+            cands.intersection_update(p)
+            if not cands:
+                break
+        # trigrams only narrow it down; confirm the real substring
+        return [i for i in cands if ql in self.titles[i] or ql in self.groups[i]]
+
+    def search(self, query: str):
+        ql = query.strip().lower()
+        if not ql:
+            return []
+        ranked = []
+        for i in self._candidates(ql):
+            title = self.titles[i]
+            if title == ql:
+                score = 0
+            elif title.startswith(ql):
+                score = 1
+            elif (" " + ql) in title:
+                score = 2
+            elif ql in title:
+                score = 3
+            else:
+                score = 4     # group match only
+            ranked.append((score, i))
+        ranked.sort()
+        return [i for _, i in ranked]
+
+def make_entry(name: str, channels, fetched: float, etag=None, last_modified=None, index_state=None):
+    entry = {
+        "version": next(PLAYLIST_VERSION),   # bumped for every new parse; 304s keep it
+        "time": fetched,
+        "channels": channels,
+        "etag": etag,
+        "last_modified": last_modified,
+    }
+    if name in SEARCH_INDEXED:
+        if index_state is not None and len(index_state[0]) == len(channels):
+            entry["index"] = SearchIndex.restore(channels, index_state)
+        else:
+            entry["index"] = SearchIndex(channels)
+    return entry
+
+def get_search_index(name: str):
+    get_channels(name)
+    cached = CACHE.get(name)
+    if not cached:
+        return None
+    if "index" not in cached:
+        # playlists outside SEARCH_INDEXED get one built on first search
+        cached["index"] = SearchIndex(cached["channels"])
+    return cached["index"]
+
+# ============================================================
+# On-disk playlist store (body + validators, survives restarts)
+# plus a marshal snapshot of the parse so a restart skips parsing
+# ============================================================
+SNAPSHOT_FORMAT = (1, marshal.version, sys.version_info[:2], sys.byteorder)
+PLAYLIST_STORE_DIR = os.environ.get(
+    "PLAYLIST_STORE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "playlists")
+)
+
+def _store_paths(name: str):
+    base = os.path.join(PLAYLIST_STORE_DIR, name)
+    return base + ".m3u", base + ".json", base + ".snap"
+
+def _write_atomic(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def open_store_tmp(name: str):
+    body_path = _store_paths(name)[0]
+    tmp = f"{body_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(PLAYLIST_STORE_DIR, exist_ok=True)
+        return tmp, open(tmp, "wb")
+    except OSError as e:
+        logging.warning("[%s] Could not store playlist: %s", name, e)
+        return None, None
+
+def write_snapshot(path: str, entry: dict):
+    index = entry.get("index")
+    data = marshal.dumps((
+        SNAPSHOT_FORMAT,
+        entry.get("etag"),
+        entry.get("last_modified"),
+        [ch.fields() for ch in entry["channels"]],
+        index.state() if index is not None else None,
+    ))
+    _write_atomic(path, data)
+
+def read_snapshot(path: str, meta: dict):
+    # (rows, index state) if the snapshot belongs to the stored body, else None
+    try:
+        with open(path, "rb") as f:
+            fmt, etag, last_modified, rows, index_state = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if fmt != SNAPSHOT_FORMAT or (etag, last_modified) != (meta.get("etag"), meta.get("last_modified")):
+        return None
+    return rows, index_state
+
+def store_playlist(name: str, entry: dict, body_tmp=None):
+    body_path, meta_path, snap_path = _store_paths(name)
+    meta = {
+        "url": PLAYLISTS[name],
+        "time": entry["time"],
+        "etag": entry.get("etag"),
+        "last_modified": entry.get("last_modified"),
+    }
+    try:
+        os.makedirs(PLAYLIST_STORE_DIR, exist_ok=True)
+        if body_tmp is not None:
+            # new parse: body and snapshot first, so the meta never points at a stale snapshot
+            os.replace(body_tmp, body_path)
+            write_snapshot(snap_path, entry)
+        _write_atomic(meta_path, json.dumps(meta).encode())
+    except OSError as e:
+        logging.warning("[%s] Could not store playlist: %s", name, e)
+
+def load_stored_playlist(name: str):
+    body_path, meta_path, snap_path = _store_paths(name)
+    started = time.perf_counter()
+    index_state = None
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("url") != PLAYLISTS[name]:
+            return None
+        snap = read_snapshot(snap_path, meta)
+        if snap is not None:
+            rows, index_state = snap
+            channels = ChannelList(array("I", (CHANNELS.add(*row) for row in rows)))
+        else:
+            with open(body_path, encoding="utf-8", errors="replace") as f:
+                channels = CHANNELS.collect(iter_m3u(f))
+    except (OSError, ValueError):
+        return None
+    entry = make_entry(name, channels, meta.get("time", 0),
+                       meta.get("etag"), meta.get("last_modified"), index_state)
+    logging.info("[%s] Loaded %d channels from %s in %.0fms", name, len(channels),
+                 "snapshot" if snap is not None else "disk", (time.perf_counter() - started) * 1000)
+    return entry
+
+# ============================================================
+# Shared cross-worker cache (optional): parsed playlists in one SQLite file.
+# Under gunicorn one worker takes a playlist's lease, fetches and publishes it;
+# the others attach to the published rows instead of downloading and parsing.
+# ============================================================
+SHARED_CACHE_DB = os.environ.get("SHARED_CACHE_DB", "")
+SHARED_LEASE_SECONDS = 90     # longer than fetch + parse; a dead refresher's lease just lapses
+SHARED_WAIT = 30              # a cold worker waits this long for the refresher's result
+SHARED_CACHE_EVENTS = Counter("restream_shared_cache_total", "Shared playlist cache events", ("event",))
+
+SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    name TEXT PRIMARY KEY, generation INTEGER, fetched REAL, etag TEXT, last_modified TEXT
+);
+CREATE TABLE IF NOT EXISTS channels (
+    playlist TEXT, pos INTEGER, title TEXT, url TEXT, logo TEXT, grp TEXT, tvg_id TEXT,
+    PRIMARY KEY (playlist, pos)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL);
+CREATE TABLE IF NOT EXISTS health (url TEXT PRIMARY KEY, ok INTEGER, status INTEGER, ttfb REAL, checked REAL);
+CREATE INDEX IF NOT EXISTS health_checked ON health (checked);
+"""
+
+class SharedStore:
+    # readers attach read-only; only the lease holder for a playlist writes it
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()     # sqlite connections are per thread
+
+    def _connect(self, writable=False):
+        attr = "rw" if writable else "ro"
+        conn = getattr(self.local, attr, None)
+        if conn is None:
+            if writable:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SHARED_SCHEMA)
+            else:
+                conn = sqlite3.connect(f"file:{quote(self.path)}?mode=ro", uri=True,
+                                       timeout=30, isolation_level=None)
+            setattr(self.local, attr, conn)
+        return conn
+
+    def attach(self, name: str) -> bool:
+        # install the published entry if it is newer than ours
+        cached = CACHE.get(name)
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN")       # one snapshot for the header and its rows
+            try:
+                row = conn.execute("SELECT generation, fetched, etag, last_modified FROM playlists "
+                                   "WHERE name = ?", (name,)).fetchone()
+                if row is None or (cached and cached["time"] >= row[1]):
+                    return False
+                generation, fetched, etag, last_modified = row
+                if cached and cached.get("generation") == generation:
+                    # revalidated elsewhere (304): same channels, newer time
+                    CACHE[name] = dict(cached, time=fetched, etag=etag, last_modified=last_modified)
+                    return True
+                rows = conn.execute("SELECT title, url, logo, grp, tvg_id FROM channels "
+                                    "WHERE playlist = ? ORDER BY pos", (name,)).fetchall()
+            finally:
+                conn.execute("COMMIT")
+        except sqlite3.Error:
+            return False    # nothing published yet
+        channels = ChannelList(array("I", (CHANNELS.add(*r) for r in rows)))
+        entry = make_entry(name, channels, fetched, etag, last_modified)
+        entry["generation"] = generation
+        CACHE[name] = entry
+        PLAYLIST_CHANNELS.set(name, value=len(channels))
+        SHARED_CACHE_EVENTS.inc("attached")
+        logging.info("[%s] Attached %d channels from the shared cache", name, len(channels))
+        return True
+
+    def publish(self, name: str, entry: dict):
+        # rows are only rewritten for a new parse; a 304 just moves the timestamp
+        generation = entry.get("generation")
+        try:
+            conn = self._connect(writable=True)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if generation is None:
+                    generation = (conn.execute("SELECT MAX(generation) FROM playlists").fetchone()[0] or 0) + 1
+                    conn.execute("DELETE FROM channels WHERE playlist = ?", (name,))
+                    conn.executemany("INSERT INTO channels VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     ((name, pos) + ch.fields() for pos, ch in enumerate(entry["channels"])))
+                conn.execute("INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?)",
+                             (name, generation, entry["time"], entry.get("etag"), entry.get("last_modified")))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logging.warning("[%s] Could not publish to shared cache: %s", name, e)
+            return
+        entry["generation"] = generation
+        SHARED_CACHE_EVENTS.inc("published")
+
+    def lease(self, name: str, seconds=SHARED_LEASE_SECONDS) -> bool:
+        now = time.time()
+        try:
+            cur = self._connect(writable=True).execute(
+                "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE "
+                "SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE leases.expires < ? OR leases.owner = excluded.owner",
+                (name, str(os.getpid()), now + seconds, now))
+        except sqlite3.Error as e:
+            logging.warning("[%s] Shared cache lease failed, refreshing locally: %s", name, e)
+            return True
+        return cur.rowcount == 1
+
+    def release(self, name: str):
+        try:
+            self._connect(writable=True).execute(
+                "DELETE FROM leases WHERE name = ? AND owner = ?", (name, str(os.getpid())))
+        except sqlite3.Error:
+            pass
+
+    def publish_health(self, results: dict):
+        # one transaction per batch: followers never see part of it (checked is not commit order)
+        try:
+            conn = self._connect(writable=True)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO health VALUES (?, ?, ?, ?, ?)",
+                                 ((url, r["ok"], r["status"], r["ttfb"], r["checked"]) for url, r in results.items()))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logging.warning("[prober] Could not publish to shared cache: %s", e)
+
+    def load_health(self, since: float):
+        try:
+            return self._connect().execute(
+                "SELECT url, ok, status, ttfb, checked FROM health WHERE checked > ?", (since,)).fetchall()
+        except sqlite3.Error:
+            return []
+
+    def wait(self, name: str, timeout=SHARED_WAIT) -> bool:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(0.5)
+            if self.attach(name):
+                return True
+        return False
+
+SHARED = SharedStore(SHARED_CACHE_DB) if SHARED_CACHE_DB else None
+
+# ============================================================
+# Derived views (optional): every country/category/language playlist
+# built as an index over one parse of index.m3u
+# ============================================================
+DERIVE_VIEWS = os.environ.get("DERIVE_VIEWS", "0") == "1"
+MASTER_PLAYLIST = "all"
+IPTV_API = "https://iptv-org.github.io/api"
+VIEW_META = {}    # "time", "channels": id -> (country, categories), "feeds": (id, feed) -> (languages, countries)
+_VIEW_RE = re.compile(r"/(countries|categories|languages)/(\w+)\.m3u$")
+
+def view_spec(name: str):
+    m = _VIEW_RE.search(PLAYLISTS.get(name, ""))
+    return (m.group(1), m.group(2).lower()) if m else None
+
+def is_derived(name: str) -> bool:
+    return DERIVE_VIEWS and name != MASTER_PLAYLIST and view_spec(name) is not None
+
+def load_view_meta():
+    if VIEW_META and time.time() - VIEW_META["time"] < REFRESH_INTERVAL:
+        return VIEW_META
+    logging.info("[views] Fetching iptv-org metadata")
+    try:
+        resp = requests.get(f"{IPTV_API}/channels.json", timeout=25)
+        resp.raise_for_status()
+        channels = {
+            c["id"]: ((c.get("country") or "").lower(), tuple(c.get("categories") or ()))
+            for c in resp.json()
+        }
+        resp = requests.get(f"{IPTV_API}/feeds.json", timeout=25)
+        resp.raise_for_status()
+        feeds = {}
+        for f in resp.json():
+            langs = tuple(f.get("languages") or ())
+            areas = tuple(a[2:].lower() for a in f.get("broadcast_area") or () if a.startswith("c/"))
+            feeds[(f["channel"], f["id"])] = (langs, areas)
+            # channel-wide fallback for tvg-ids without an @feed suffix
+            all_langs, all_areas = feeds.get((f["channel"], ""), ((), ()))
+            feeds[(f["channel"], "")] = (all_langs + langs, all_areas + areas)
+    except Exception as e:
+        logging.error("[views] Metadata load failed: %s", e)
+        return VIEW_META or None
+    VIEW_META.update(time=time.time(), channels=channels, feeds=feeds)
+    return VIEW_META
+
+def publish_views(master: dict) -> bool:
+    meta = load_view_meta()
+    if not meta:
+        return False
+    targets = {}
+    for name in PLAYLISTS:
+        if is_derived(name):
+            targets.setdefault(view_spec(name), []).append(name)
+    ids = {name: array("I") for names in targets.values() for name in names}
+    records = CHANNELS.records
+    for cid in master["channels"].ids:
+        base, _, feed = records[cid].tvg_id.partition("@")
+        info = meta["channels"].get(base)
+        if info is None:
+            continue
+        country, categories = info
+        langs, areas = meta["feeds"].get((base, feed)) or meta["feeds"].get((base, ""), ((), ()))
+        keys = {("countries", country)}
+        keys.update(("countries", a) for a in areas)
+        keys.update(("categories", c) for c in categories)
+        keys.update(("languages", l) for l in langs)
+        for key in keys:
+            for name in targets.get(key, ()):
+                ids[name].append(cid)
+    changed = 0
+    for name, view in ids.items():
+        old = CACHE.get(name)
+        if old is not None and old["channels"].ids == view:
+            # same channels (e.g. the master was a 304): keep version and generation, like the master does
+            CACHE[name] = dict(old, time=master["time"])
         else:
-            i += 1
-    return channels
+            CACHE[name] = make_entry(name, ChannelList(view), master["time"])
+            changed += 1
+        if SHARED is not None:
+            SHARED.publish(name, CACHE[name])
+    logging.info("[views] Published %d views (%d changed) from %d channels",
+                 len(ids), changed, len(master["channels"]))
+    return True
+
+def refresh_views(name: str) -> bool:
+    master = get_channels(MASTER_PLAYLIST) and CACHE.get(MASTER_PLAYLIST)
+    if not master:
+        return False
+    with _refresh_lock(MASTER_PLAYLIST):
+        view = CACHE.get(name)
+        if view is None or view["time"] < master["time"]:
+            publish_views(master)
+    return name in CACHE
 
 # ============================================================
-# Cache Loader
+# Cache Loader (stale-while-revalidate, one refresh per playlist)
 # ============================================================
+REFRESH_BACKOFF_MIN = 30
+REFRESH_BACKOFF_MAX = 900
+
+REFRESH_LOCKS = {}     # name -> Lock held while that playlist is being fetched
+REFRESH_STATE = {}     # name -> {"failures": n, "retry_at": ts}
+_refresh_locks_guard = threading.Lock()
+
+def _refresh_lock(name: str):
+    with _refresh_locks_guard:
+        lock = REFRESH_LOCKS.get(name)
+        if lock is None:
+            lock = REFRESH_LOCKS[name] = threading.Lock()
+        return lock
+
+def _in_backoff(name: str) -> bool:
+    state = REFRESH_STATE.get(name)
+    return bool(state) and time.time() < state["retry_at"]
+
+def refresh_playlist(name: str):
+    # caller must hold _refresh_lock(name)
+    if SHARED is None:
+        return fetch_playlist(name)
+    if not SHARED.lease(name):
+        # another worker is refreshing: take its result when it lands
+        SHARED_CACHE_EVENTS.inc("lease_busy")
+        if not SHARED.attach(name) and name not in CACHE:
+            SHARED.wait(name)
+        return
+    try:
+        SHARED.attach(name)
+        cached = CACHE.get(name)
+        if cached and time.time() - cached["time"] < REFRESH_INTERVAL:
+            return      # published by another worker while we waited for the lease
+        fetch_playlist(name)
+    finally:
+        SHARED.release(name)
+
+def fetch_playlist(name: str):
+    if is_derived(name):
+        if refresh_views(name):
+            return
+        # metadata unavailable: fall back to the playlist's own URL
+    url = PLAYLISTS[name]
+    cached = CACHE.get(name)
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    logging.info("[%s] Fetching playlist: %s", name, url)
+    started = time.time()
+    body_tmp = None
+    try:
+        with requests.get(url, timeout=25, headers=headers, stream=True) as resp:
+            if resp.status_code == 304 and cached:
+                PLAYLIST_FETCHES.inc(name, "not_modified")
+                PLAYLIST_FETCH_SECONDS.observe(time.time() - started, name)
+                entry = dict(cached, time=started)
+                CACHE[name] = entry
+                REFRESH_STATE.pop(name, None)
+                store_playlist(name, entry)
+                if SHARED is not None:
+                    SHARED.publish(name, entry)
+                logging.info("[%s] Not modified, keeping %d channels", name, len(cached["channels"]))
+                if DERIVE_VIEWS and name == MASTER_PLAYLIST:
+                    publish_views(entry)
+                return
+            resp.raise_for_status()
+            body_tmp, out = open_store_tmp(name)
+            cpu = time.thread_time()
+            try:
+                channels = CHANNELS.collect(iter_m3u(iter_response_lines(resp, out)))
+            finally:
+                if out is not None:
+                    out.close()
+            PARSE_SECONDS.observe(time.thread_time() - cpu, name)
+            PLAYLIST_FETCH_BYTES.inc(name, amount=resp.raw.tell())
+    except Exception as e:
+        PLAYLIST_FETCHES.inc(name, "error")
+        if body_tmp is not None:
+            try:
+                os.remove(body_tmp)
+            except OSError:
+                pass
+        failures = REFRESH_STATE.get(name, {}).get("failures", 0) + 1
+        delay = min(REFRESH_BACKOFF_MAX, REFRESH_BACKOFF_MIN * 2 ** (failures - 1))
+        REFRESH_STATE[name] = {"failures": failures, "retry_at": time.time() + delay}
+        logging.error("Load failed %s: %s (retry in %ds, keeping %s)",
+                      name, e, delay, "stale list" if name in CACHE else "nothing")
+        return
+    entry = make_entry(name, channels, started,
+                       resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+    CACHE[name] = entry
+    REFRESH_STATE.pop(name, None)
+    store_playlist(name, entry, body_tmp)
+    if SHARED is not None:
+        SHARED.publish(name, entry)
+    PLAYLIST_FETCHES.inc(name, "ok")
+    PLAYLIST_FETCH_SECONDS.observe(time.time() - started, name)
+    PLAYLIST_CHANNELS.set(name, value=len(channels))
+    logging.info("[%s] Loaded %d channels", name, len(channels))
+    if DERIVE_VIEWS and name == MASTER_PLAYLIST:
+        publish_views(entry)
+
+def schedule_refresh(name: str):
+    if _in_backoff(name):
+        return
+    lock = _refresh_lock(name)
+    if not lock.acquire(blocking=False):
+        return  # already refreshing
+    def run():
+        try:
+            refresh_playlist(name)
+        finally:
+            lock.release()
+        sweep_channels()
+    threading.Thread(target=run, name=f"refresh-{name}", daemon=True).start()
+
 def get_channels(name: str):
-    now = time.time()
+    if PROBE_ENABLED:
+        PROBER.ensure_started()
     cached = CACHE.get(name)
-    if cached and now - cached.get("time", 0) < REFRESH_INTERVAL:
+    if cached:
+        if time.time() - cached.get("time", 0) >= REFRESH_INTERVAL:
+            CACHE_LOOKUPS.inc("stale")
+            schedule_refresh(name)
+        else:
+            CACHE_LOOKUPS.inc("hit")
         return cached["channels"]
 
-    url = PLAYLISTS.get(name)
-    if not url:
+    CACHE_LOOKUPS.inc("miss")
+    if name not in PLAYLISTS:
         logging.error("Playlist not found: %s", name)
         return []
 
-    logging.info("[%s] Fetching playlist: %s", name, url)
+    # cold cache: one request fetches, concurrent ones wait for its result
+    with _refresh_lock(name):
+        cached = CACHE.get(name)
+        if cached:
+            return cached["channels"]
+        if SHARED is not None and SHARED.attach(name):
+            stored = CACHE[name]
+        else:
+            stored = None if is_derived(name) else load_stored_playlist(name)
+        if stored:
+            # serve from disk now, revalidate in the background if it is old
+            CACHE[name] = stored
+        elif not _in_backoff(name):
+            refresh_playlist(name)
+    if stored and time.time() - stored["time"] >= REFRESH_INTERVAL:
+        schedule_refresh(name)
+    cached = CACHE.get(name)
+    return cached["channels"] if cached else []
+
+# ============================================================
+# Stream health prober (background asyncio loop, bounded concurrency)
+# ============================================================
+PROBE_ENABLED = os.environ.get("PROBE_ENABLED", "1") == "1"
+PROBE_CONCURRENCY = 32
+PROBE_TIMEOUT = 6          # seconds for connect + first bytes
+PROBE_BYTES = 2048         # enough for a manifest header or a few TS packets
+PROBE_INTERVAL = 3600      # re-check each URL this often
+PROBE_IDLE_SLEEP = 60
+# with SHARED_CACHE_DB one worker holds this lease and probes; the others read its results
+PROBE_LEASE = "~prober"
+PROBE_LEASE_SECONDS = 300  # renewed every batch; a dead prober's lease lapses
+PROBE_BATCH = 500
+
+HEALTH = {}    # url -> {"ok": bool, "status": int|None, "ttfb": seconds|None, "checked": ts}
+
+class StreamProber:
+    def __init__(self, concurrency=PROBE_CONCURRENCY, timeout=PROBE_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.generation = 0        # bumped when a result flips; lets page caches notice
+        self.dirty = False
+        self.synced = 0            # newest shared result loaded, when another worker probes
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def ensure_started(self):
+        if self.thread is not None or not HAVE_AIOHTTP:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=lambda: asyncio.run(self._run()), name="prober", daemon=True)
+                self.thread.start()
+
+    async def probe(self, session, url: str):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = {"ok": False, "status": None, "ttfb": None, "checked": time.time()}
+        try:
+            async with session.get(url, headers={"Range": f"bytes=0-{PROBE_BYTES - 1}"}) as resp:
+                result["status"] = resp.status
+                if resp.status < 400:
+                    head = await resp.content.read(PROBE_BYTES)
+                    result["ttfb"] = round(loop.time() - started, 3)
+                    if ".m3u8" in url or "mpegurl" in resp.headers.get("Content-Type", "").lower():
+                        result["ok"] = head.lstrip().startswith(b"#EXTM3U")
+                    else:
+                        result["ok"] = len(head) > 0
+        except Exception:
+            pass
+        return result
+
+    async def probe_many(self, urls):
+        global aiohttp
+        import aiohttp
+        queue = asyncio.Queue()
+        for url in urls:
+            queue.put_nowait(url)
+        results = {}
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=4, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=self.timeout, sock_connect=min(3, self.timeout))
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def worker():
+                while not queue.empty():
+                    url = queue.get_nowait()
+                    results[url] = await self.probe(session, url)
+                    self._record(url, results[url])
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return results
+
+    def due_urls(self):
+        now = time.time()
+        records = CHANNELS.records
+        seen = set()
+        fresh, stale = [], []
+        for entry in list(CACHE.values()):
+            for cid in entry["channels"].ids:
+                if cid in seen:
+                    continue
+                seen.add(cid)
+                url = records[cid].url
+                h = HEALTH.get(url)
+                if h is None:
+                    fresh.append(url)
+                elif now - h["checked"] >= PROBE_INTERVAL:
+                    stale.append(url)
+        # never-checked URLs first
+        return list(dict.fromkeys(fresh + stale))
+
+    def _record(self, url, result):
+        old = HEALTH.get(url)
+        HEALTH[url] = result
+        if old is None or old["ok"] != result["ok"]:
+            self.dirty = True
+
+    def _publish_generation(self):
+        if self.dirty:
+            self.dirty = False
+            self.generation += 1
+
+    def _follow(self):
+        for url, ok, status, ttfb, checked in SHARED.load_health(self.synced):
+            self._record(url, {"ok": bool(ok), "status": status, "ttfb": ttfb, "checked": checked})
+            self.synced = max(self.synced, checked)
+        self._publish_generation()
+
+    async def _round(self):
+        urls = self.due_urls()
+        if not urls:
+            return
+        started = time.time()
+        live = 0
+        for i in range(0, len(urls), PROBE_BATCH):
+            if SHARED is not None and i and not SHARED.lease(PROBE_LEASE, PROBE_LEASE_SECONDS):
+                break
+            results = await self.probe_many(urls[i:i + PROBE_BATCH])
+            if SHARED is not None:
+                SHARED.publish_health(results)
+            live += sum(1 for r in results.values() if r["ok"])
+            self._publish_generation()
+        logging.info("[prober] %d/%d live in %.1fs", live, len(urls), time.time() - started)
+
+    async def _run(self):
+        while True:
+            if SHARED is not None and not SHARED.lease(PROBE_LEASE, PROBE_LEASE_SECONDS):
+                self._follow()      # another worker is probing
+            else:
+                await self._round()
+            await asyncio.sleep(PROBE_IDLE_SLEEP)
+
+PROBER = StreamProber()
+
+def is_live(ch) -> bool:
+    h = HEALTH.get(ch.url)
+    return bool(h and h["ok"])
+
+def health_rank(ch):
+    h = HEALTH.get(ch.url)
+    if h is None:
+        return (1, 0)
+    return (0, h["ttfb"]) if h["ok"] else (2, 0)
+
+def health_marks(channels) -> bytes:
+    # what a page shows per channel (unknown / down / up), so caches notice only real changes
+    return bytes(0 if h is None else 1 + h["ok"] for h in map(HEALTH.get, (ch.url for ch in channels)))
+
+def pick_random(channels):
+    # prefer channels the prober has seen working
+    live = [ch for ch in channels if is_live(ch)]
+    return random.choice(live or channels)
+
+# ============================================================
+# Shared transcode sessions (one ffmpeg per source + profile)
+# ============================================================
+TS_PACKET = 188
+READ_SIZE = 64 * 1024
+SESSION_RING_BYTES = 4 * 1024 * 1024   # backlog kept per session; slower viewers are dropped
+SESSION_IDLE_GRACE = 20                # keep ffmpeg alive this long after the last viewer leaves
+SUBSCRIBER_TIMEOUT = 60                # viewers give up on a session that produces nothing (restarts included)
+SESSION_EVICT_AFTER = 3                # unwatched this long -> may be evicted when at capacity
+
+# supervisor: stalled or exited ffmpeg is restarted, rotating through alternate sources
+SESSION_STALL_TIMEOUT = 10             # no output and no -progress advance for this long -> kill
+SESSION_START_TIMEOUT = 20             # allowance for connect + probe before the first output
+SESSION_MAX_RESTARTS = 5               # within SESSION_RESTART_WINDOW; then the session ends
+SESSION_RESTART_WINDOW = 300
+SESSION_RESTART_BACKOFF = 1            # seconds before a restart, doubling for each one in the window
+SESSION_RESTART_BACKOFF_MAX = 8
+SESSION_DIAG_LINES = 50                # stderr / supervisor lines kept per session
+PROGRESS_KEYS = {"frame", "fps", "bitrate", "total_size", "out_time_us", "out_time_ms", "out_time",
+                 "dup_frames", "drop_frames", "speed", "progress", "stream_0_0_q"}
+
+# admission control: ffmpeg sessions are CPU bound, so cap them
+MAX_TRANSCODES = int(os.environ.get("MAX_TRANSCODES", (os.cpu_count() or 1) * 2))
+TRANSCODE_QUEUE = int(os.environ.get("TRANSCODE_QUEUE", 8))     # requests allowed to wait for a slot
+TRANSCODE_QUEUE_TIMEOUT = 10
+TRANSCODE_RETRY_AFTER = 15
+
+# sources kept transcoding even with no viewers, so joining them is instant:
+# comma-separated channel ids, stream URLs or <group>/<index> entries
+PREWARM_240P = [s.strip() for s in os.environ.get("PREWARM_240P", "").split(",") if s.strip()]
+PREWARM_INTERVAL = 15
+PREWARM_THREAD = None
+PREWARM_LOCK_FILE = None               # flock held by the one process that owns the pinned sessions
+_prewarm_guard = threading.Lock()
+
+# HLS output mode: segments + sliding playlist on tmpfs
+LOWDATA_MODE = os.environ.get("LOWDATA_MODE", "ts")     # /watch-240p pages: "ts", "hls" (240p) or "abr" (adaptive ladder)
+HLS_ROOT = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "restream-hls")
+HLS_SEGMENT_SECONDS = 4
+HLS_WINDOW = 6
+HLS_READY_TIMEOUT = 20
+
+VIDEO_STREAM_TYPES = (0x1B, 0x24)    # H.264, HEVC
+
+def ts_keyframe_offset(buf: bytes, video_pid=None) -> int:
+    # offset of the first video packet with random_access_indicator set, or -1
+    # (muxers flag every audio frame as random access too, so the PID matters;
+    # without a known video PID, e.g. audio-only, any PID counts)
+    for off in range(0, len(buf) - TS_PACKET + 1, TS_PACKET):
+        if (buf[off] == 0x47 and buf[off + 3] & 0x20
+                and buf[off + 4] > 0 and buf[off + 5] & 0x40
+                and (video_pid is None or ts_pid(buf, off) == video_pid)):
+            return off
+    return -1
+
+def ts_pid(buf: bytes, off: int) -> int:
+    return ((buf[off + 1] & 0x1F) << 8) | buf[off + 2]
+
+def ts_section_start(pkt: bytes) -> int:
+    # offset of the PSI section in a packet with payload_unit_start set, or -1
+    off = 4
+    if pkt[3] & 0x20:
+        off += 1 + pkt[4]
+    if off >= TS_PACKET:
+        return -1
+    off += 1 + pkt[off]     # pointer_field
+    return off if off + 3 <= TS_PACKET else -1
+
+def pat_pmt_pids(pkt: bytes) -> set:
+    # PMT PIDs listed in a single-packet PAT
+    off = ts_section_start(pkt)
+    if off < 0 or pkt[off] != 0x00:
+        return set()
+    end = min(off + 3 + (((pkt[off + 1] & 0x0F) << 8) | pkt[off + 2]) - 4, TS_PACKET)
+    pids = set()
+    for p in range(off + 8, end - 3, 4):
+        if (pkt[p] << 8) | pkt[p + 1]:      # program 0 points at the NIT
+            pids.add(((pkt[p + 2] & 0x1F) << 8) | pkt[p + 3])
+    return pids
+
+def pmt_video_pid(pkt: bytes):
+    # elementary PID of the first video stream in a single-packet PMT, or None
+    off = ts_section_start(pkt)
+    if off < 0 or pkt[off] != 0x02 or off + 12 > TS_PACKET:
+        return None
+    end = min(off + 3 + (((pkt[off + 1] & 0x0F) << 8) | pkt[off + 2]) - 4, TS_PACKET)
+    p = off + 12 + (((pkt[off + 10] & 0x0F) << 8) | pkt[off + 11])
+    while p + 5 <= end:
+        if pkt[p] in VIDEO_STREAM_TYPES:
+            return ((pkt[p + 1] & 0x1F) << 8) | pkt[p + 2]
+        p += 5 + (((pkt[p + 3] & 0x0F) << 8) | pkt[p + 4])
+    return None
+
+def with_progress(cmd):
+    # machine-readable progress on stderr, once a second, next to any error lines
+    return cmd[:1] + ["-progress", "pipe:2", "-stats_period", "1"] + cmd[1:]
+
+def terminate_process(proc):
+    if proc is None:
+        return
     try:
-        resp = requests.get(url, timeout=25)
-        resp.raise_for_status()
-        channels = parse_m3u(resp.text)
-        CACHE[name] = {"time": now, "channels": channels}
-        logging.info("[%s] Loaded %d channels", name, len(channels))
-        return channels
-    except Exception as e:
-        logging.error("Load failed %s: %s", name, e)
-        return []
+        proc.terminate()
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    except Exception:
+        pass
+
+class ChunkRing:
+    # byte-bounded ring of packet-aligned TS chunks; callers hold the session lock
+    def __init__(self, limit=SESSION_RING_BYTES):
+        self.limit = limit
+        self.chunks = deque()      # (bytes, starts_with_keyframe)
+        self.size = 0
+        self.first_seq = 0         # seq of chunks[0]
+        self.next_seq = 0          # seq the next appended chunk gets
+        self.keyframe_seq = None   # most recent chunk starting at a keyframe
+        self.pending = b""
+        self.pat = None            # latest PAT/PMT packets, replayed to viewers joining mid-stream
+        self.pmt = {}
+        self.video_pid = None      # from the PMT; when known, only its random-access packets are keyframes
+
+    def feed(self, data: bytes) -> bool:
+        # split at the first keyframe so late joiners can start there
+        self.pending += data
+        cut = len(self.pending) - len(self.pending) % TS_PACKET
+        if not cut:
+            return False
+        block, self.pending = self.pending[:cut], self.pending[cut:]
+        self._scan_psi(block)
+        kf = ts_keyframe_offset(block, self.video_pid)
+        if kf > 0:
+            self._append(block[:kf], False)
+            self._append(block[kf:], True)
+        else:
+            self._append(block, kf == 0)
+        return True
+
+    def _append(self, data: bytes, keyframe: bool):
+        if keyframe:
+            self.keyframe_seq = self.next_seq
+        self.chunks.append((data, keyframe))
+        self.size += len(data)
+        self.next_seq += 1
+        while self.size > self.limit and len(self.chunks) > 1:
+            old, _ = self.chunks.popleft()
+            self.size -= len(old)
+            self.first_seq += 1
+        if self.keyframe_seq is not None and self.keyframe_seq < self.first_seq:
+            self.keyframe_seq = None
+
+    def _scan_psi(self, block: bytes):
+        for off in range(0, len(block), TS_PACKET):
+            if not block[off + 1] & 0x40:      # only packets starting a section
+                continue
+            pid = ts_pid(block, off)
+            # pmt is replaced, never mutated: threaded viewers read it in psi() without the lock
+            if pid == 0:
+                self.pat = block[off:off + TS_PACKET]
+                self.pmt = {p: self.pmt.get(p) for p in pat_pmt_pids(self.pat)}
+            elif pid in self.pmt:
+                pmt = block[off:off + TS_PACKET]
+                self.pmt = {**self.pmt, pid: pmt}
+                self.video_pid = pmt_video_pid(pmt)
+
+    def psi(self) -> bytes:
+        # PAT + PMTs, so a decoder can start on the cached keyframe without waiting for the next table
+        pat, pmt = self.pat, self.pmt       # one snapshot; the pump may swap either meanwhile
+        if pat is None or not pmt or None in pmt.values():
+            return b""
+        return pat + b"".join(pmt.values())
+
+    def join_seq(self):
+        # the last keyframe still in the ring: new viewers get that whole GOP at once
+        return self.keyframe_seq if self.keyframe_seq is not None else self.next_seq
+
+    def since(self, seq):
+        return list(islice(self.chunks, seq - self.first_seq, None))
+
+class Supervised:
+    # restart bookkeeping shared by piped and HLS sessions: rotate sources, back off, give up
+    def __init__(self, key, sources, build):
+        self.key = key
+        self.label = "%s %s" % (key[1], key[0])
+        self.sources = sources     # requested URL first, then alternates for the same tvg_id
+        self.source_idx = 0
+        self.build = build         # source URL -> ffmpeg argv
+        self.restarts = deque()    # restart times within SESSION_RESTART_WINDOW
+        self.diag = deque(maxlen=SESSION_DIAG_LINES)
+        self.end_reason = None
+        self.stalled = False
+
+    def note(self, line: str):
+        self.diag.append("%s %s" % (time.strftime("%H:%M:%S"), line))
+
+    def _restart_delay(self, reason):
+        # seconds to wait before running the next source, or None once the restart budget is spent
+        now = time.time()
+        while self.restarts and now - self.restarts[0] > SESSION_RESTART_WINDOW:
+            self.restarts.popleft()
+        if len(self.restarts) >= SESSION_MAX_RESTARTS:
+            self.end_reason = "restart_limit"
+            self.note("[supervisor] giving up after %d restarts" % len(self.restarts))
+            return None
+        self.restarts.append(now)
+        self.source_idx = (self.source_idx + 1) % len(self.sources)
+        delay = min(SESSION_RESTART_BACKOFF * 2 ** (len(self.restarts) - 1), SESSION_RESTART_BACKOFF_MAX)
+        TRANSCODE_RESTARTS.inc(self.key[1], reason)
+        logging.warning("[transcode] restarting %s on source %d/%d in %ds (%s)",
+                        self.label, self.source_idx + 1, len(self.sources), delay, reason)
+        self.stalled = False
+        return delay
+
+    def _kill(self):
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+
+class TranscodeSession(Supervised):
+    def __init__(self, key, sources, build):
+        super().__init__(key, sources, build)
+        self.cmd = None
+        self.proc = None
+        self.cond = threading.Condition()
+        self.ring = ChunkRing()
+        self.viewers = 0
+        self.idle_since = time.time()
+        self.closed = False
+        self.stopping = False
+        self.relayed = 0
+        self.pinned = False
+        # supervisor state
+        self.last_alive = time.time()   # last stdout bytes or -progress advance
+        self.produced = False           # current ffmpeg has written output
+        self.progress = {}              # latest ffmpeg -progress values
+
+    def start(self):
+        logging.info("[transcode] start %s", self.label)
+        threading.Thread(target=self._pump, daemon=True).start()
+
+    def _ended(self, reason):
+        TRANSCODE_SESSION_ENDS.inc(self.key[1], self.end_reason or reason)
+        TRANSCODE_SESSION_BYTES.observe(self.relayed, self.key[1])
+        logging.info("[transcode] stopped %s", self.label)
+
+    def stop(self, reason="idle"):
+        self.stopping = True
+        terminate_process(self.proc)
+        self._ended(reason)
+
+    def _command(self):
+        url = self.sources[self.source_idx]
+        self.note("[supervisor] starting ffmpeg on source %d/%d: %s" % (self.source_idx + 1, len(self.sources), url))
+        self.cmd = with_progress(self.build(url))
+        return self.cmd
+
+    def _stderr_line(self, raw: bytes):
+        line = raw.decode("utf-8", "replace").rstrip()
+        key, sep, value = line.partition("=")
+        if sep and key in PROGRESS_KEYS:
+            if key == "out_time_us" and value != self.progress.get(key):
+                self.last_alive = time.time()
+            self.progress[key] = value
+        elif line:
+            self.note(line)
+
+    def _got_output(self, data: bytes):
+        self.last_alive = time.time()
+        self.produced = True
+        return self.ring.feed(data)
+
+    def check_stall(self, now):
+        # called by the registry's supervisor loop; the pump sees the process die and restarts it
+        if self.closed or self.stopping or self.proc is None or self.stalled:
+            return
+        limit = SESSION_STALL_TIMEOUT if self.produced else SESSION_START_TIMEOUT
+        if now - self.last_alive > limit:
+            self.stalled = True
+            self.note("[supervisor] no output or progress for %ds, killing ffmpeg" % (now - self.last_alive))
+            logging.warning("[transcode] stalled %s", self.label)
+            self._kill()
+
+    def _next_source(self, returncode):
+        # after an ffmpeg exit: the backoff before running the next source, or None to let the session close
+        reason = "stall" if self.stalled else "exit"
+        self.note("[supervisor] ffmpeg %s (exit code %s)" % ("stalled" if self.stalled else "exited", returncode))
+        if self.stopping or (self.viewers == 0 and not self.pinned):
+            return None
+        delay = self._restart_delay(reason)
+        if delay is None:
+            return None
+        self.produced = False
+        self.last_alive = time.time() + delay
+        self.ring.pending = b""     # drop the old process's partial packet
+        return delay
+
+    def diagnostics(self):
+        return {
+            "active_source": self.sources[self.source_idx],
+            "alternates": len(self.sources) - 1,
+            "restarts": len(self.restarts),
+            "speed": self.progress.get("speed"),
+            "log": list(self.diag),
+        }
+
+    def _spawn(self):
+        proc = subprocess.Popen(
+            self._command(),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0
+        )
+        self.proc = proc
+        if self.stopping:
+            terminate_process(proc)
+        threading.Thread(target=self._drain_stderr, args=(proc,), daemon=True).start()
+        return proc
+
+    def _drain_stderr(self, proc):
+        for raw in iter(proc.stderr.readline, b""):
+            self._stderr_line(raw)
+
+    def _pump(self):
+        spawned = time.time()
+        first = True
+        try:
+            while not self.stopping:
+                proc = self._spawn()
+                while True:
+                    data = proc.stdout.read(READ_SIZE)
+                    if not data:
+                        break
+                    if first:
+                        TRANSCODE_FIRST_BYTE.observe(time.time() - spawned, self.key[1])
+                        first = False
+                    with self.cond:
+                        if self._got_output(data):
+                            self.cond.notify_all()
+                terminate_process(proc)
+                delay = self._next_source(proc.returncode)
+                if delay is None:
+                    break
+                time.sleep(delay)
+        except Exception as e:
+            logging.error("[transcode] read failed %s: %s", self.label, e)
+            self.note("[supervisor] %s" % e)
+        finally:
+            with self.cond:
+                if not self.stopping and not self.end_reason:
+                    self.end_reason = "upstream_eof"
+                self.closed = True
+                self.cond.notify_all()
+
+    def is_idle(self, now, grace):
+        return self.viewers == 0 and now - self.idle_since > grace
+
+    def _viewer_left(self, reason, sent):
+        TRANSCODE_VIEWER_ENDS.inc(self.key[1], reason)
+        TRANSCODE_RELAYED.inc(self.key[1], amount=sent)
+        self.relayed += sent
+        self.viewers -= 1
+        if self.viewers == 0:
+            self.idle_since = time.time()
+
+    def subscribe(self):
+        ring = self.ring
+        with self.cond:
+            self.viewers += 1
+            seq = ring.join_seq()
+        synced = False
+        reason = "client_disconnect"
+        sent = 0
+        try:
+            while True:
+                with self.cond:
+                    while seq >= ring.next_seq and not self.closed:
+                        if not self.cond.wait(SUBSCRIBER_TIMEOUT):
+                            logging.warning("[transcode] no data for %ss: %s", SUBSCRIBER_TIMEOUT, self.label)
+                            reason = "timeout"
+                            return
+                    if seq < ring.first_seq:
+                        logging.info("[transcode] dropping slow viewer of %s", self.label)
+                        reason = "slow_client"
+                        return
+                    if seq >= ring.next_seq:
+                        reason = "upstream_eof"
+                        return
+                    batch = ring.since(seq)
+                    seq = ring.next_seq
+                for data, keyframe in batch:
+                    if not synced:
+                        if not keyframe:
+                            continue
+                        synced = True
+                        data = ring.psi() + data
+                    yield data
+                    sent += len(data)
+        finally:
+            with self.cond:
+                self._viewer_left(reason, sent)
+
+class AsyncTranscodeSession(TranscodeSession):
+    # same ring and registry bookkeeping, but the ffmpeg pipe and every viewer live on one event loop;
+    # the registry may call start/stop from any thread, so both only schedule work on the loop
+    def __init__(self, key, sources, build, loop):
+        super().__init__(key, sources, build)
+        self.loop = loop
+        self.cond = asyncio.Condition()
+
+    def start(self):
+        logging.info("[transcode] start %s (async)", self.label)
+        asyncio.run_coroutine_threadsafe(self._pump(), self.loop)
+
+    def stop(self, reason="idle"):
+        self.stopping = True
+        asyncio.run_coroutine_threadsafe(self._terminate(), self.loop)
+        self._ended(reason)
+
+    def _kill(self):
+        self.loop.call_soon_threadsafe(self._kill_now)
+
+    def _kill_now(self):
+        if self.proc is not None and self.proc.returncode is None:
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass
+
+    async def _terminate(self):
+        proc = self.proc
+        if proc is None or proc.returncode is not None:
+            return
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), 5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+        except ProcessLookupError:
+            pass
 
+    async def _drain_stderr(self, proc):
+        async for raw in proc.stderr:
+            self._stderr_line(raw)
 
+    async def _pump(self):
+        spawned = time.time()
+        first = True
+        try:
+            while not self.stopping:
+                cmd = await asyncio.to_thread(self._command)    # may run ffprobe
+                proc = self.proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE
+                )
+                if self.stopping:
+                    break
+                drain = asyncio.ensure_future(self._drain_stderr(proc))
+                while True:
+                    data = await proc.stdout.read(READ_SIZE)
+                    if not data:
+                        break
+                    if first:
+                        TRANSCODE_FIRST_BYTE.observe(time.time() - spawned, self.key[1])
+                        first = False
+                    if self._got_output(data):
+                        async with self.cond:
+                            self.cond.notify_all()
+                await self._terminate()
+                await drain
+                delay = self._next_source(proc.returncode)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+        except Exception as e:
+            logging.error("[transcode] read failed %s: %s", self.label, e)
+            self.note("[supervisor] %s" % e)
+        finally:
+            if not self.stopping and not self.end_reason:
+                self.end_reason = "upstream_eof"
+            self.closed = True
+            async with self.cond:
+                self.cond.notify_all()
+            await self._terminate()
+
+    async def subscribe(self):
+        ring = self.ring
+        self.viewers += 1
+        seq = ring.join_seq()
+        synced = False
+        reason = "client_disconnect"
+        sent = 0
+        try:
+            while True:
+                async with self.cond:
+                    while seq >= ring.next_seq and not self.closed:
+                        try:
+                            await asyncio.wait_for(self.cond.wait(), SUBSCRIBER_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            logging.warning("[transcode] no data for %ss: %s", SUBSCRIBER_TIMEOUT, self.label)
+                            reason = "timeout"
+                            return
+                if seq < ring.first_seq:
+                    logging.info("[transcode] dropping slow viewer of %s", self.label)
+                    reason = "slow_client"
+                    return
+                if seq >= ring.next_seq:
+                    reason = "upstream_eof"
+                    return
+                batch = ring.since(seq)
+                seq = ring.next_seq
+                for data, keyframe in batch:
+                    if not synced:
+                        if not keyframe:
+                            continue
+                        synced = True
+                        data = ring.psi() + data
+                    yield data
+                    sent += len(data)
+        finally:
+            self._viewer_left(reason, sent)
+
+class HlsSession(Supervised):
+    # ffmpeg writes segments to out_dir; a supervisor thread restarts it in place on exit or stall
+    def __init__(self, key, sources, build, sid, out_dir, playlist="index.m3u8"):
+        super().__init__(key, sources, build)
+        self.sid = sid
+        self.out_dir = out_dir
+        self.playlist = playlist
+        self.proc = None
+        self.viewers = 0           # HLS viewers are tracked by request activity instead
+        self.idle_since = time.time()
+        self.pinned = False
+        self.started = time.time()
+        self.closed = False
+        self.stopping = False
+
+    def touch(self):
+        self.idle_since = time.time()
+
+    def is_idle(self, now, grace):
+        # players refresh the playlist every segment, so silence longer than a few segments means gone
+        return now - self.idle_since > max(grace, HLS_SEGMENT_SECONDS * 3)
+
+    def start(self):
+        logging.info("[transcode] start %s -> %s", self.label, self.out_dir)
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+        os.makedirs(self.out_dir, exist_ok=True)
+        threading.Thread(target=self._supervise, daemon=True).start()
+
+    def _spawn(self):
+        url = self.sources[self.source_idx]
+        self.note("[supervisor] starting ffmpeg on source %d/%d: %s" % (self.source_idx + 1, len(self.sources), url))
+        cmd = self.build(url)       # may run ffprobe
+        self.started = time.time()
+        proc = self.proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        if self.stopping:
+            terminate_process(proc)
+        threading.Thread(target=self._drain_stderr, args=(proc,), daemon=True).start()
+        return proc
+
+    def _drain_stderr(self, proc):
+        for raw in iter(proc.stderr.readline, b""):
+            line = raw.decode("utf-8", "replace").rstrip()
+            if line:
+                self.note(line)
+
+    def _supervise(self):
+        try:
+            while not self.stopping:
+                proc = self._spawn()
+                proc.wait()
+                if self.stopping:
+                    break
+                # same directory, so the playlist carries on (append_list) and players keep polling it
+                reason = "stall" if self.stalled else "exit"
+                self.note("[supervisor] ffmpeg %s (exit code %s)" % ("stalled" if self.stalled else "exited", proc.returncode))
+                if self.is_idle(time.time(), SESSION_IDLE_GRACE) and not self.pinned:
+                    break
+                delay = self._restart_delay(reason)
+                if delay is None:
+                    break
+                time.sleep(delay)
+        except Exception as e:
+            logging.error("[transcode] supervise failed %s: %s", self.label, e)
+            self.note("[supervisor] %s" % e)
+        finally:
+            if not self.stopping and not self.end_reason:
+                self.end_reason = "upstream_eof"
+            self.closed = True
+
+    def check_stall(self, now):
+        # segments stopped appearing: kill ffmpeg and let the supervisor move to the next source
+        proc = self.proc
+        if self.closed or self.stopping or self.stalled or proc is None or proc.poll() is not None:
+            return
+        try:
+            newest = max((e.stat().st_mtime for e in os.scandir(self.out_dir)), default=0)
+        except OSError:
+            newest = 0
+        if newest > self.started:
+            stalled = now - newest > HLS_SEGMENT_SECONDS + SESSION_STALL_TIMEOUT
+        else:
+            stalled = now - self.started > SESSION_START_TIMEOUT
+        if stalled:
+            self.stalled = True
+            logging.warning("[transcode] stalled %s", self.label)
+            self.note("[supervisor] no new segments, killing ffmpeg")
+            self._kill()
+
+    def diagnostics(self):
+        return {
+            "active_source": self.sources[self.source_idx],
+            "alternates": len(self.sources) - 1,
+            "restarts": len(self.restarts),
+            "log": list(self.diag),
+        }
+
+    def stop(self, reason="idle"):
+        self.stopping = True
+        terminate_process(self.proc)
+        TRANSCODE_SESSION_ENDS.inc(self.key[1], self.end_reason or reason)
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+        logging.info("[transcode] stopped %s", self.label)
+
+    def wait_playlist(self, timeout: float):
+        path = os.path.join(self.out_dir, self.playlist)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+            if self.closed or time.time() > deadline:
+                return None
+            time.sleep(0.2)
+
+class TranscodeBusy(Exception):
+    pass
+
+class TranscodeRegistry:
+    def __init__(self, max_sessions=MAX_TRANSCODES, max_queue=TRANSCODE_QUEUE):
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+        self.sessions = {}
+        self.max_sessions = max_sessions
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.rejected = 0
+        self.reaper = None
+
+    def _active(self):
+        return sum(1 for s in self.sessions.values() if not s.closed)
+
+    def active_count(self):
+        with self.lock:
+            return self._active()
+
+    @staticmethod
+    def _expired(session, now, grace):
+        return session.closed or (not session.pinned and session.is_idle(now, grace))
+
+    def _evict_idle(self, now):
+        # make room by dropping sessions nobody is watching (they are only in their grace period)
+        idle = [(s.idle_since, k) for k, s in self.sessions.items()
+                if self._expired(s, now, SESSION_EVICT_AFTER)]
+        if not idle:
+            return None
+        _, key = min(idle)
+        return self.sessions.pop(key)
+
+    def acquire(self, key, factory, pinned=False):
+        evicted = []
+        try:
+            with self.lock:
+                session = self.sessions.get(key)
+                if session is None or session.closed:
+                    # sessions that already have viewers are always joined; only new ones are admitted
+                    deadline = time.time() + TRANSCODE_QUEUE_TIMEOUT
+                    while self._active() >= self.max_sessions:
+                        victim = self._evict_idle(time.time())
+                        if victim is not None:
+                            evicted.append(victim)
+                            continue
+                        remaining = deadline - time.time()
+                        if self.waiting >= self.max_queue or remaining <= 0:
+                            self.rejected += 1
+                            raise TranscodeBusy()
+                        self.waiting += 1
+                        try:
+                            self.slot_freed.wait(remaining)
+                        finally:
+                            self.waiting -= 1
+                    session = self.sessions.get(key)
+                    if session is None or session.closed:
+                        if session is not None:
+                            evicted.append(session)     # dead, not yet reaped: clean it up too
+                        session = factory(key)
+                        session.start()
+                        self.sessions[key] = session
+                # hold off the reaper until the caller subscribes
+                session.idle_since = time.time()
+                session.pinned = session.pinned or pinned
+                if self.reaper is None:
+                    self.reaper = threading.Thread(target=self._reap_loop, daemon=True)
+                    self.reaper.start()
+                return session
+        finally:
+            for victim in evicted:
+                if not victim.closed:
+                    logging.info("[transcode] evicting idle %s for a new viewer", victim.label)
+                victim.stop("evicted")
+
+    def has(self, key) -> bool:
+        with self.lock:
+            session = self.sessions.get(key)
+            return session is not None and not session.closed
+
+    def find_sid(self, sid):
+        with self.lock:
+            for session in self.sessions.values():
+                if getattr(session, "sid", None) == sid:
+                    return session
+        return None
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            return {
+                "max_sessions": self.max_sessions,
+                "active": self._active(),
+                "queued": self.waiting,
+                "max_queue": self.max_queue,
+                "rejected": self.rejected,
+                "sessions": [
+                    {
+                        "profile": key[1],
+                        "source": key[0],
+                        "viewers": s.viewers,
+                        "pinned": s.pinned,
+                        "idle_for": 0 if not s.is_idle(now, 0) else round(now - s.idle_since, 1),
+                        **s.diagnostics(),
+                    }
+                    for key, s in self.sessions.items()
+                ],
+            }
+
+    def _reap_loop(self):
+        # also the supervisor: stalled sessions get their ffmpeg killed and restarted by their pump
+        while True:
+            time.sleep(2)
+            now = time.time()
+            expired = []
+            with self.lock:
+                for key, session in list(self.sessions.items()):
+                    if self._expired(session, now, SESSION_IDLE_GRACE):
+                        del self.sessions[key]
+                        expired.append(session)
+                if expired:
+                    self.slot_freed.notify_all()
+                running = list(self.sessions.values())
+            # terminate/wait off the request path
+            for session in expired:
+                session.stop()
+            for session in running:
+                session.check_stall(now)
+
+TRANSCODES = TranscodeRegistry()
+
+Gauge("restream_transcode_active", "Running ffmpeg sessions", read=TRANSCODES.active_count)
+Gauge("restream_transcode_capacity", "Maximum concurrent ffmpeg sessions", read=lambda: TRANSCODES.max_sessions)
+Gauge("restream_transcode_queued", "Requests waiting for a transcode slot", read=lambda: TRANSCODES.waiting)
 
 # ============================================================
 # HTML TEMPLATES
@@ -214,12 +2062,15 @@ button.k{padding:6px 8px;border-radius:6px;border:1px solid #0f0;background:#111
 input#search{width:60%;padding:8px;border-radius:6px;border:1px solid #0f0;background:#111;color:#0f0}
 .keypad{margin-top:8px}
 .kbtn{padding:8px;width:36px;border-radius:6px;margin:2px;border:1px solid #0f0;background:#111;color:#0f0}
+.pager{margin:12px 0}
 </style>
 </head>
 <body>
 <h3>{{ group|capitalize }} Channels</h3>
 <a href="/">← Back</a>
 <a class="btn" href="/random/{{ group }}" style="background:#0f0;color:#000">🎲 Random</a>
+<a class="btn" href="?live=1">🟢 Live only</a>
+<a class="btn" href="?sort=health">⚡ Fastest first</a>
 
 <div style="margin-top:10px;">
   <input id="search" placeholder="Type or use keypad..." >
@@ -227,24 +2078,38 @@ input#search{width:60%;padding:8px;border-radius:6px;border:1px solid #0f0;backg
   <button class="k" onclick="clearSearch()">✖</button>
 </div>
 
+{% macro pager() %}
+{% if pages > 1 %}
+<div class="pager">
+  {% if page > 1 %}<a class="btn" href="?page={{ page - 1 }}&limit={{ limit }}{{ extra }}">← Prev</a>{% endif %}
+  Page {{ page }} / {{ pages }} ({{ total }} channels)
+  {% if page < pages %}<a class="btn" href="?page={{ page + 1 }}&limit={{ limit }}{{ extra }}">Next →</a>{% endif %}
+</div>
+{% endif %}
+{% endmacro %}
+{{ pager() }}
+
 <div id="channelList" style="margin-top:12px;">
-{% for ch in channels %}
+{% for idx, ch in rows %}
+{% set h = health.get(ch.url) %}
 <div class="card" data-url="{{ ch.url }}" data-title="{{ ch.title }}">
-  <div style="font-size:20px;width:40px;text-align:center;color:#0f0">{{ loop.index }}.</div>
+  <div style="font-size:20px;width:40px;text-align:center;color:#0f0">{{ idx + 1 }}.</div>
 
-  <img src="{{ ch.logo or fallback }}" onerror="this.src='{{ fallback }}'">
+  <img src="{{ ch.logo or fallback }}" loading="lazy" onerror="this.src='{{ fallback }}'">
 
   <div style="flex:1">
     <strong>{{ ch.title }}</strong>
+    {% if h %}<span title="checked by prober">{{ "🟢" if h.ok else "🔴" }}</span>{% endif %}
     <div style="margin-top:6px">
-      <a class="btn" href="/watch/{{ group }}/{{ loop.index0 }}" target="_blank">▶️</a>
-<a class="btn" href="/watch-240p/{{ group }}/{{ loop.index0 }}" target="_blank">📉 240p</a>
+      <a class="btn" href="/watch/{{ ch.id }}" target="_blank">▶️</a>
+<a class="btn" href="/watch-240p/{{ ch.id }}" target="_blank">📉 240p</a>
       <button class="k" onclick='addFav("{{ ch.title|replace('"','&#34;') }}","{{ ch.url }}","{{ ch.logo }}")'>⭐</button>
     </div>
   </div>
 </div>
 {% endfor %}
 </div>
+{{ pager() }}
 
 <script>
 /* keypad + search integration */
@@ -317,7 +2182,7 @@ input#q{width:70%;padding:8px;border-radius:6px;border:1px solid #0f0;background
       <div style="flex:1">
         <strong>{{ r.title }}</strong>
         <div style="margin-top:6px">
-          <a class="btn" href="/watch/all/{{ r.index }}" target="_blank">▶ Watch</a>
+          <a class="btn" href="/watch/{{ r.id }}" target="_blank">▶ Watch</a>
          
           <button class="k" onclick='addFav("{{ r.title|replace('"','&#34;') }}","{{ r.url }}","{{ r.logo }}")'>⭐</button>
         </div>
@@ -435,7 +2300,7 @@ video{
 
 <!-- Video Player -->
 <video id="vid" controls autoplay playsinline>
-  <source src="{{ channel.url }}" type="{{ mime_type }}">
+  <source src="{{ src or channel.url }}" type="{{ mime_type }}">
 </video>
 
 <script>
@@ -537,58 +2402,204 @@ loadFavs();
 </html>
 """
 
+# ============================================================
+# Compiled templates + rendered page cache
+# ============================================================
+TEMPLATE_SOURCES = {
+    "home": HOME_HTML,
+    "list": LIST_HTML,
+    "search": SEARCH_HTML,
+    "watch": WATCH_HTML,
+    "fav": FAV_HTML,
+}
+TEMPLATES = {}     # compiled on first render, not at import
+
+def get_template(name: str):
+    tpl = TEMPLATES.get(name)
+    if tpl is None:
+        tpl = TEMPLATES[name] = app.jinja_env.from_string(TEMPLATE_SOURCES[name])
+    return tpl
+
+RENDER_CACHE_MAX = 256
+LIST_PAGE_SIZE = 100             # cards per /list page unless ?limit= says otherwise
+LIST_STREAM_THRESHOLD = 500      # pages bigger than this are streamed, not cached
+RENDER_CACHE = OrderedDict()     # key -> CachedBody, LRU
+SEARCH_CACHE_MAX = 64
+SEARCH_CACHE = OrderedDict()     # /api/search bodies: unbounded key space, kept apart from the pages
+_render_cache_lock = threading.Lock()
+
+class CachedBody:
+    __slots__ = ("version", "mimetype", "etag", "raw", "gzip", "br")
+
+    def __init__(self, version, body: bytes, mimetype: str):
+        self.version = version
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+        self.raw = body
+        self.gzip = None        # compressed on first request for that encoding, then kept
+        self.br = None
+
+    def response(self):
+        # strong validators must differ per content-coding, so each encoding gets its own ETag
+        accept = request.accept_encodings
+        if brotli and accept["br"]:
+            if self.br is None:
+                self.br = brotli.compress(self.raw, quality=5)
+            body, coding, etag = self.br, "br", self.etag + "-br"
+        elif accept["gzip"]:
+            if self.gzip is None:
+                self.gzip = gzip.compress(self.raw, 6)
+            body, coding, etag = self.gzip, "gzip", self.etag + "-gz"
+        else:
+            body, coding, etag = self.raw, None, self.etag
+        if request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        else:
+            resp = Response(body, mimetype=self.mimetype)
+            if coding:
+                resp.headers["Content-Encoding"] = coding
+        resp.set_etag(etag)
+        resp.headers["Vary"] = "Accept-Encoding"
+        resp.headers["Cache-Control"] = "no-cache"   # always revalidate; a 304 is nearly free
+        return resp
+
+def cached_response(key, version, render, mimetype="text/html", cache=RENDER_CACHE, max_items=RENDER_CACHE_MAX):
+    with _render_cache_lock:
+        hit = cache.get(key)
+        if hit is not None:
+            cache.move_to_end(key)
+    if hit is None or hit.version != version:
+        body = render()
+        hit = CachedBody(version, body.encode() if isinstance(body, str) else body, mimetype)
+        with _render_cache_lock:
+            cache[key] = hit
+            cache.move_to_end(key)
+            while len(cache) > max_items:
+                cache.popitem(last=False)
+    return hit.response()
+
+def render(template: str, **context):
+    started = time.perf_counter()
+    body = render_template(get_template(template), **context)
+    RENDER_SECONDS.observe(time.perf_counter() - started, request.endpoint or template)
+    return body
+
+def get_entry(name: str):
+    # the cache entry itself, so channels and version always belong together
+    get_channels(name)
+    return CACHE.get(name)
+
 # ============================================================
 # ROUTES
 # ============================================================
 
 @app.route("/")
 def home():
-    return render_template_string(HOME_HTML, playlists=PLAYLISTS)
+    return cached_response(
+        ("home",), 0,
+        lambda: render("home", playlists=PLAYLISTS)
+    )
+
+def _page_args(total: int):
+    limit = request.args.get("limit", LIST_PAGE_SIZE, type=int)
+    if limit <= 0:
+        limit = max(total, 1)      # ?limit=0 -> everything on one page
+    pages = max(1, -(-total // limit))
+    page = min(max(request.args.get("page", 1, type=int), 1), pages)
+    return page, limit, pages
+
+def _buffered(chunks, size=32 * 1024):
+    buf, n = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        n += len(chunk)
+        if n >= size:
+            yield "".join(buf)
+            buf, n = [], 0
+    if buf:
+        yield "".join(buf)
+
+def _list_rows(channels):
+    # ?live=1 / ?sort=health as (position, channel) rows; None means "all of them, in order"
+    live_only = request.args.get("live") == "1"
+    by_health = request.args.get("sort") == "health"
+    rows = list(enumerate(channels)) if live_only or by_health else None
+    if live_only:
+        rows = [(i, ch) for i, ch in rows if is_live(ch)]
+    if by_health:
+        rows.sort(key=lambda row: health_rank(row[1]))
+    extra = ("&live=1" if live_only else "") + ("&sort=health" if by_health else "")
+    return rows, extra
+
+def _page_rows(channels, rows, start, limit):
+    if rows is not None:
+        return rows[start:start + limit]
+    return zip(range(start, start + limit), channels[start:start + limit])
 
 @app.route("/list/<group>")
 def list_group(group):
     if group not in PLAYLISTS:
         abort(404)
-    channels = get_channels(group)
-    return render_template_string(LIST_HTML, group=group, channels=channels, fallback=LOGO_FALLBACK)
+    entry = get_entry(group)
+    channels = entry["channels"] if entry else []
+    rows, extra = _list_rows(channels)
+    total = len(rows) if rows is not None else len(channels)
+    page, limit, pages = _page_args(total)
+    page_rows = _page_rows(channels, rows, (page - 1) * limit, limit)
+    context = dict(
+        group=group, rows=page_rows, page=page, pages=pages, limit=limit, total=total,
+        extra=extra, health=HEALTH, fallback=LOGO_FALLBACK
+    )
+    if limit > LIST_STREAM_THRESHOLD:
+        # big pages: send cards as they render instead of building the whole document first
+        return Response(_buffered(stream_template(get_template("list"), **context)), mimetype="text/html")
+    if entry is None:
+        return render("list", **context)
+    # filtered/sorted pages depend on every result; plain ones only on the markers they show
+    page_rows = context["rows"] = list(page_rows)
+    health = PROBER.generation if extra else health_marks(ch for _, ch in page_rows)
+    return cached_response(
+        ("list", group, page, limit, extra), (entry["version"], health),
+        lambda: render("list", **context)
+    )
 
 @app.route("/favourites")
 def favourites():
-    return render_template_string(FAV_HTML)
+    return cached_response(("fav",), 0, lambda: render("fav"))
 
 @app.route("/search")
 def search():
     q = request.args.get("q", "").strip()
     # if no query, show page with empty results
     if not q:
-        return render_template_string(SEARCH_HTML, query="", results=[], fallback=LOGO_FALLBACK)
+        return render("search", query="", results=[], fallback=LOGO_FALLBACK)
 
-    ql = q.lower()
-    # search in the 'all' playlist for a flat list
-    all_channels = get_channels("all")
+    # search the 'all' playlist for a flat list
+    index = get_search_index("all")
     results = []
-    for idx, ch in enumerate(all_channels):
-        title = (ch.get("title") or "").lower()
-        group = (ch.get("group") or "").lower()
-        # match against title or group or url
-        if ql in title or ql in group or ql in (ch.get("url") or "").lower():
+    if index is not None:
+        started = time.perf_counter()
+        found = index.search(q)
+        SEARCH_SECONDS.observe(time.perf_counter() - started)
+        for idx in found:
+            ch = index.channels[idx]
             results.append({
-                "index": idx,
-                "title": ch.get("title"),
-                "url": ch.get("url"),
-                "logo": ch.get("logo"),
+                "id": ch.id,
+                "title": ch.title,
+                "url": ch.url,
+                "logo": ch.logo,
             })
-    return render_template_string(SEARCH_HTML, query=q, results=results, fallback=LOGO_FALLBACK)
+    return render("search", query=q, results=results, fallback=LOGO_FALLBACK)
 
 @app.route("/random")
 def random_global():
     channels = get_channels("all")
     if not channels:
         abort(404)
-    ch = random.choice(channels)
-    url = ch["url"]
+    ch = pick_random(channels)
+    url = ch.url
     mime = "application/vnd.apple.mpegurl" if ".m3u8" in url else "video/mp4"
-    return render_template_string(WATCH_HTML, channel=ch, mime_type=mime)
+    return render("watch", channel=ch, mime_type=mime, src=player_source(url))
 
 @app.route("/random/<group>")
 def random_category(group):
@@ -597,22 +2608,44 @@ def random_category(group):
     channels = get_channels(group)
     if not channels:
         abort(404)
-    ch = random.choice(channels)
-    url = ch["url"]
+    ch = pick_random(channels)
+    url = ch.url
     mime = "application/vnd.apple.mpegurl" if ".m3u8" in url else "video/mp4"
-    return render_template_string(WATCH_HTML, channel=ch, mime_type=mime)
+    return render("watch", channel=ch, mime_type=mime, src=player_source(url))
+
+def find_channel(channel_id: str):
+    ch = CHANNELS.get(channel_id)
+    if ch is None:
+        # cold start: ids resolve once the master playlist is loaded
+        get_channels(MASTER_PLAYLIST)
+        ch = CHANNELS.get(channel_id)
+    return ch
+
+def channel_or_404(channel_id: str):
+    ch = find_channel(channel_id)
+    if ch is None:
+        abort(404)
+    return ch
 
-@app.route("/watch/<group>/<int:idx>")
-def watch_channel(group, idx):
+def channel_at(group: str, idx: int):
+    # old position-based URLs: resolve against the current list, then use the stable id
     if group not in PLAYLISTS:
         abort(404)
     channels = get_channels(group)
     if idx < 0 or idx >= len(channels):
         abort(404)
-    ch = channels[idx]
-    url = ch["url"]
+    return channels[idx]
+
+@app.route("/watch/<channel_id>")
+def watch_channel(channel_id):
+    ch = channel_or_404(channel_id)
+    url = ch.url
     mime = "application/vnd.apple.mpegurl" if ".m3u8" in url else "video/mp4"
-    return render_template_string(WATCH_HTML, channel=ch, mime_type=mime)
+    return render("watch", channel=ch, mime_type=mime, src=player_source(url))
+
+@app.route("/watch/<group>/<int:idx>")
+def watch_channel_at(group, idx):
+    return redirect(f"/watch/{channel_at(group, idx).id}")
 
 
 @app.route("/watch/fav/<int:index>")
@@ -623,7 +2656,7 @@ def watch_fav(index):
         return "Favorite not found", 404
 
     mime_type = "application/x-mpegURL" if channel['url'].endswith('.m3u8') else "video/mp4"
-    return render_template_string(WATCH_HTML, channel=channel, mime_type=mime_type)
+    return render("watch", channel=channel, mime_type=mime_type)
 
 
 @app.route("/play-240p-direct")
@@ -660,13 +2693,32 @@ def watch_direct():
         "logo": logo
     }
 
-    return render_template_string(WATCH_HTML, channel=channel, mime_type=mime)
+    # arbitrary URLs play directly; only listed channels may go through the proxy
+    src = player_source(url) if CHANNELS.has_url(url) else None
+    return render("watch", channel=channel, mime_type=mime, src=src)
 
 # ============================================================
-# 240p Low-data video proxy (no audio)
+# 240p Low-data video proxy
 # ============================================================
-def proxy_video_240p(source_url: str):
-    cmd = [
+# Encoding profiles live in data; the ffmpeg argument lists are built from them.
+PROFILES = {
+    "240p": {"height": 240, "fps": 12, "v_bitrate": "45k", "maxrate": "50k", "bufsize": "90k",
+             "a_bitrate": "16k", "a_rate": 22050},
+}
+
+# Adaptive ladder: one decode, split into every rendition below (+ audio-only)
+LADDER = [
+    {"name": "144p", "height": 144, "fps": 10, "v_bitrate": "30k", "maxrate": "35k", "bufsize": "60k",
+     "a_bitrate": "16k", "a_rate": 22050},
+    {"name": "240p", "height": 240, "fps": 12, "v_bitrate": "45k", "maxrate": "50k", "bufsize": "90k",
+     "a_bitrate": "16k", "a_rate": 22050},
+    {"name": "360p", "height": 360, "fps": 15, "v_bitrate": "150k", "maxrate": "180k", "bufsize": "300k",
+     "a_bitrate": "32k", "a_rate": 44100},
+    {"name": "audio", "audio_only": True, "a_bitrate": "16k", "a_rate": 22050},
+]
+
+def input_args(source_url: str):
+    return [
         "ffmpeg", "-loglevel", "error",
 
         # 🔁 reconnect safety (important for IPTV)
@@ -675,104 +2727,408 @@ def proxy_video_240p(source_url: str):
         "-reconnect_delay_max", "5",
 
         "-i", source_url,
+    ]
 
-        # 🔻 240p with reduced fps
-        "-vf", "scale=-2:240,fps=12",
-
-        # 🎥 VIDEO
-        "-c:v", "libx264",
-        "-profile:v", "baseline",
-        "-level", "3.0",
-        "-preset", "ultrafast",
-        "-tune", "zerolatency",
-        "-pix_fmt", "yuv420p",
-
-        # 🔻 LOW video bitrate
-        "-b:v", "45k",
-        "-maxrate", "50k",
-        "-bufsize", "90k",
-
-        # streaming-friendly GOP
-        "-g", "24",
-        "-keyint_min", "24",
-        "-sc_threshold", "0",
+# 🎥 VIDEO: baseline H.264, tuned for cheap real-time encodes
+X264_ARGS = [
+    "-c:v", "libx264",
+    "-profile:v", "baseline",
+    "-level", "3.0",
+    "-preset", "ultrafast",
+    "-tune", "zerolatency",
+    "-pix_fmt", "yuv420p",
+    "-sc_threshold", "0",
+]
+
+def build_profile_cmd(source_url: str, profile: dict, output=None):
+    gop = str(profile["fps"] * 2)     # streaming-friendly GOP: 2 seconds
+    return input_args(source_url) + [
+        # 🔻 reduced size and fps
+        "-vf", f"scale=-2:{profile['height']},fps={profile['fps']}",
+    ] + X264_ARGS + [
+        "-b:v", profile["v_bitrate"],
+        "-maxrate", profile["maxrate"],
+        "-bufsize", profile["bufsize"],
+        "-g", gop,
+        "-keyint_min", gop,
 
         # 🔊 AUDIO (ultra-low, but audible)
         "-c:a", "aac",
         "-ac", "1",          # mono
-        "-ar", "22050",      # low sample rate
-        "-b:a", "16k",
-
+        "-ar", str(profile["a_rate"]),
+        "-b:a", profile["a_bitrate"],
+    ] + (output or [
         # stream-safe container
         "-f", "mpegts",
         "pipe:1"
+    ])
+
+def build_240p_cmd(source_url: str, output=None):
+    return build_profile_cmd(source_url, PROFILES["240p"], output)
+
+def build_remux_cmd(source_url: str, output=None):
+    # source already fits the profile: repackage only, no decode/encode
+    return input_args(source_url) + [
+        "-map", "0:v:0",
+        "-map", "0:a:0?",
+        "-c", "copy",
+    ] + (output or [
+        "-f", "mpegts",
+        "pipe:1"
+    ])
+
+# ============================================================
+# ffprobe cache: pick remux vs transcode per source
+# ============================================================
+MEDIA_INFO_TTL = 6 * 3600
+MEDIA_INFO_FAIL_TTL = 300
+FFPROBE_TIMEOUT = 10
+REMUX_BITRATE_SLACK = 1.5          # accept sources up to 1.5x the profile's total bitrate
+MEDIA_INFO = {}                    # url -> (expires, info or None)
+
+TRANSCODE_PATHS = Counter("restream_transcode_path_total", "Sessions started, by remux/transcode path",
+                          ("profile", "path"))
+
+def _bits(rate: str) -> int:
+    rate = str(rate).lower()
+    return int(float(rate[:-1]) * 1000) if rate.endswith("k") else int(float(rate))
+
+def probe_media(url: str):
+    hit = MEDIA_INFO.get(url)
+    if hit and hit[0] > time.time():
+        return hit[1]
+    info = None
+    try:
+        out = subprocess.run([
+            "ffprobe", "-v", "error",
+            "-show_entries", "stream=codec_type,codec_name,height,bit_rate:format=bit_rate",
+            "-of", "json", url
+        ], capture_output=True, timeout=FFPROBE_TIMEOUT, check=True).stdout
+        data = json.loads(out or b"{}")
+        video = next((st for st in data.get("streams", []) if st.get("codec_type") == "video"), None)
+        audio = next((st for st in data.get("streams", []) if st.get("codec_type") == "audio"), None)
+        bitrate = (data.get("format") or {}).get("bit_rate")
+        if video is not None:
+            info = {
+                "video_codec": video.get("codec_name"),
+                "height": video.get("height") or 0,
+                "audio_codec": audio.get("codec_name") if audio else None,
+                "bit_rate": int(bitrate) if bitrate and str(bitrate).isdigit() else None,
+            }
+    except (OSError, subprocess.SubprocessError, ValueError) as e:
+        logging.info("[probe] ffprobe failed for %s: %s", url, e)
+    MEDIA_INFO[url] = (time.time() + (MEDIA_INFO_TTL if info else MEDIA_INFO_FAIL_TTL), info)
+    return info
+
+def fits_profile(info, profile: dict) -> bool:
+    if not info or info["video_codec"] != "h264" or info["audio_codec"] not in (None, "aac"):
+        return False
+    if not info["height"] or info["height"] > profile["height"]:
+        return False
+    budget = (_bits(profile["v_bitrate"]) + _bits(profile["a_bitrate"])) * REMUX_BITRATE_SLACK
+    return info["bit_rate"] is not None and info["bit_rate"] <= budget
+
+def choose_240p_cmd(source_url: str, name: str, output=None):
+    profile = PROFILES["240p"]
+    info = probe_media(source_url)
+    path = "remux" if fits_profile(info, profile) else "transcode"
+    TRANSCODE_PATHS.inc(name, path)
+    logging.info("[transcode] %s path=%s %s (%s)", name, path, source_url, info)
+    if path == "remux":
+        return build_remux_cmd(source_url, output)
+    return build_240p_cmd(source_url, output)
+
+def build_ladder_cmd(source_url: str, out_dir: str, sid: str, ladder=LADDER):
+    info = probe_media(source_url)
+    # audio is mapped only when ffprobe saw it: -var_stream_map entries must name streams that exist,
+    # so video-only sources and sources ffprobe could not read get a video-only ladder
+    has_audio = info is not None and info["audio_codec"] is not None
+    if not has_audio:
+        ladder = [r for r in ladder if not r.get("audio_only")]
+    video = [r for r in ladder if not r.get("audio_only")]
+    split = "".join(f"[s{i}]" for i in range(len(video)))
+    graph = [f"[0:v]split={len(video)}{split}"]
+    for i, r in enumerate(video):
+        graph.append(f"[s{i}]scale=-2:{r['height']},fps={r['fps']}[v{i}]")
+    cmd = input_args(source_url) + ["-filter_complex", ";".join(graph)]
+    streams = []
+    for i, r in enumerate(video):
+        gop = str(r["fps"] * 2)
+        cmd += ["-map", f"[v{i}]",
+                f"-b:v:{i}", r["v_bitrate"], f"-maxrate:v:{i}", r["maxrate"], f"-bufsize:v:{i}", r["bufsize"],
+                f"-g:v:{i}", gop, f"-keyint_min:v:{i}", gop]
+    for i, r in enumerate(ladder):
+        if not has_audio:
+            streams.append(f"v:{i},name:{r['name']}")
+            continue
+        cmd += ["-map", "0:a:0?", f"-b:a:{i}", r["a_bitrate"], f"-ar:a:{i}", str(r["a_rate"])]
+        streams.append(f"a:{i},name:{r['name']}" if r.get("audio_only") else
+                       f"v:{video.index(r)},a:{i},name:{r['name']}")
+    return cmd + X264_ARGS + [
+        "-c:a", "aac", "-ac", "1",
+        "-var_stream_map", " ".join(streams),
+        "-master_pl_name", "master.m3u8",
+        "-f", "hls",
+        "-hls_time", str(HLS_SEGMENT_SECONDS),
+        "-hls_list_size", str(HLS_WINDOW),
+        "-hls_flags", "delete_segments+temp_file+omit_endlist+independent_segments+append_list",
+        "-hls_delete_threshold", "2",
+        "-hls_base_url", f"/hls/{sid}/",
+        "-hls_segment_filename", os.path.join(out_dir, "%v_%05d.ts"),
+        os.path.join(out_dir, "%v.m3u8")
     ]
 
-    proc = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL,
-        bufsize=0
-    )
+def build_240p_hls_output(out_dir: str, sid: str):
+    return [
+        "-f", "hls",
+        "-hls_time", str(HLS_SEGMENT_SECONDS),
+        "-hls_list_size", str(HLS_WINDOW),
+        # old segments are removed as the window slides; temp_file avoids serving half-written ones;
+        # append_list lets a restarted ffmpeg continue the same playlist
+        "-hls_flags", "delete_segments+temp_file+omit_endlist+append_list",
+        "-hls_delete_threshold", "2",
+        "-hls_base_url", f"/hls/{sid}/",
+        "-hls_segment_filename", os.path.join(out_dir, "seg_%05d.ts"),
+        os.path.join(out_dir, "index.m3u8")
+    ]
 
-    try:
-        while True:
-            data = proc.stdout.read(64 * 1024)
-            if not data:
-                break
-            yield data
-    finally:
+def source_candidates(source_url: str, tvg_id=""):
+    # the requested URL, then other playlists' URLs for the same channel, healthiest first
+    alternates = sorted(CHANNELS.alternates(source_url, tvg_id), key=health_rank)
+    return [source_url] + [u for u in dict.fromkeys(ch.url for ch in alternates)]
+
+def ts_240p_factory(source_url: str, tvg_id="", loop=None):
+    # session factory for TRANSCODES.acquire; ffprobe + command building happen in the session's pump
+    build = lambda url: choose_240p_cmd(url, "240p")
+
+    def factory(key):
+        sources = source_candidates(source_url, tvg_id)
+        if loop is not None:
+            return AsyncTranscodeSession(key, sources, build, loop)
+        return TranscodeSession(key, sources, build)
+    return factory
+
+def proxy_video_240p(source_url: str, tvg_id=""):
+    # one ffmpeg per (source, profile); every viewer reads the same ring buffer
+    session = TRANSCODES.acquire((source_url, "240p"), ts_240p_factory(source_url, tvg_id))
+    return session.subscribe()
+
+def prewarm_source(spec: str):
+    if "://" in spec:
+        return spec
+    if "/" not in spec:
+        ch = find_channel(spec)
+        if ch is None:
+            raise LookupError("unknown channel id")
+        return ch.url
+    group, _, idx = spec.rpartition("/")
+    channels = get_channels(group)
+    return channels[int(idx)].url
+
+def prewarm_owner() -> bool:
+    # one process pins the sessions; gunicorn siblings keep trying and take over if the owner dies
+    global PREWARM_LOCK_FILE
+    if PREWARM_LOCK_FILE is None:
+        os.makedirs(HLS_ROOT, exist_ok=True)
+        f = open(os.path.join(HLS_ROOT, "prewarm.lock"), "a")
         try:
-            proc.terminate()
-            time.sleep(0.5)
-            if proc.poll() is None:
-                proc.kill()
-        except:
-            pass
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        PREWARM_LOCK_FILE = f
+        logging.info("[prewarm] pid %d pins %d 240p sessions", os.getpid(), len(PREWARM_240P))
+    return True
+
+def prewarm_loop(loop=None):
+    # keep pinned sessions running; ones that gave up (restart limit) get reaped and restarted here
+    while True:
+        if not prewarm_owner():
+            time.sleep(PREWARM_INTERVAL)
+            continue
+        for spec in PREWARM_240P:
+            try:
+                source_url = prewarm_source(spec)
+                key = (source_url, "240p")
+                if not TRANSCODES.has(key):
+                    TRANSCODES.acquire(key, ts_240p_factory(source_url, loop=loop), pinned=True)
+            except TranscodeBusy:
+                logging.warning("[prewarm] no free transcoder for %s", spec)
+            except Exception as e:
+                logging.warning("[prewarm] %s: %s", spec, e)
+        time.sleep(PREWARM_INTERVAL)
+
+def start_prewarm(loop=None):
+    # called at startup and again from every request, so gunicorn workers start it too
+    global PREWARM_THREAD
+    if not PREWARM_240P or PREWARM_THREAD is not None:
+        return
+    with _prewarm_guard:
+        if PREWARM_THREAD is None:
+            PREWARM_THREAD = threading.Thread(target=prewarm_loop, args=(loop,), name="prewarm", daemon=True)
+            PREWARM_THREAD.start()
+
+@app.before_request
+def _background_tasks():
+    start_prewarm()
+
+def _session_dir(profile: str, source_url: str):
+    # unique per instance: a replacement must not share the directory an old session is still removing
+    sid = "%s-%s" % (hashlib.sha1(f"{profile}|{source_url}".encode()).hexdigest()[:12], os.urandom(4).hex())
+    return sid, os.path.join(HLS_ROOT, sid)
+
+def hls_240p_session(source_url: str, tvg_id=""):
+    # ffprobe + command building happen on the session's supervisor thread, once per source tried
+    def factory(key):
+        sid, out_dir = _session_dir(key[1], source_url)
+        build = lambda url: choose_240p_cmd(url, key[1], build_240p_hls_output(out_dir, sid))
+        return HlsSession(key, source_candidates(source_url, tvg_id), build, sid, out_dir)
+    return TRANSCODES.acquire((source_url, "240p-hls"), factory)
+
+def hls_ladder_session(source_url: str, tvg_id=""):
+    def factory(key):
+        sid, out_dir = _session_dir(key[1], source_url)
+        build = lambda url: build_ladder_cmd(url, out_dir, sid)
+        return HlsSession(key, source_candidates(source_url, tvg_id), build, sid, out_dir, "master.m3u8")
+    return TRANSCODES.acquire((source_url, "abr"), factory)
+
+def serve_hls_playlist(source_url: str, adaptive=False, tvg_id=""):
+    if adaptive:
+        session = hls_ladder_session(source_url, tvg_id)
+    else:
+        session = hls_240p_session(source_url, tvg_id)
+    playlist = session.wait_playlist(HLS_READY_TIMEOUT)
+    if playlist is None:
+        abort(504)
+    if adaptive:
+        # ffmpeg lists renditions relative to the master; point them at the session directory
+        playlist = b"\n".join(
+            line if not line.strip() or line.startswith(b"#") else f"/hls/{session.sid}/".encode() + line.strip()
+            for line in playlist.splitlines()
+        ) + b"\n"
+    return Response(
+        playlist,
+        mimetype="application/vnd.apple.mpegurl",
+        headers={
+            "Access-Control-Allow-Origin": "*",
+            "Cache-Control": "no-cache"
+        }
+    )
 
-@app.route("/play-240p/<group>/<int:idx>")
-def play_240p(group, idx):
-    if group not in PLAYLISTS:
+@app.route("/hls-240p/<channel_id>/index.m3u8")
+def hls_240p(channel_id):
+    ch = channel_or_404(channel_id)
+    return serve_hls_playlist(ch.url, tvg_id=ch.tvg_id)
+
+@app.route("/hls-240p/<group>/<int:idx>/index.m3u8")
+def hls_240p_at(group, idx):
+    ch = channel_at(group, idx)
+    return serve_hls_playlist(ch.url, tvg_id=ch.tvg_id)
+
+@app.route("/hls-240p-direct/index.m3u8")
+def hls_240p_direct():
+    u = request.args.get("u")
+    if not u:
         abort(404)
+    return serve_hls_playlist(u)
 
-    channels = get_channels(group)
-    if idx < 0 or idx >= len(channels):
+@app.route("/hls-abr/<channel_id>/master.m3u8")
+def hls_abr(channel_id):
+    ch = channel_or_404(channel_id)
+    return serve_hls_playlist(ch.url, adaptive=True, tvg_id=ch.tvg_id)
+
+@app.route("/hls-abr/<group>/<int:idx>/master.m3u8")
+def hls_abr_at(group, idx):
+    ch = channel_at(group, idx)
+    return serve_hls_playlist(ch.url, adaptive=True, tvg_id=ch.tvg_id)
+
+@app.route("/hls-abr-direct/master.m3u8")
+def hls_abr_direct():
+    u = request.args.get("u")
+    if not u:
         abort(404)
+    return serve_hls_playlist(u, adaptive=True)
+
+@app.route("/hls/<sid>/<name>")
+def hls_segment(sid, name):
+    session = TRANSCODES.find_sid(sid)
+    if session is None or not name.endswith((".ts", ".m3u8")):
+        abort(404)
+    session.touch()
+    if name.endswith(".m3u8"):
+        # rendition playlists of the adaptive ladder; they change every segment
+        resp = send_from_directory(session.out_dir, name, mimetype="application/vnd.apple.mpegurl")
+        resp.headers["Cache-Control"] = "no-cache"
+        resp.headers["Access-Control-Allow-Origin"] = "*"
+        return resp
+    resp = send_from_directory(session.out_dir, name, mimetype="video/mp2t", conditional=True)
+    # a segment never changes once written, so any client or cache can keep it for the window
+    resp.headers["Cache-Control"] = f"public, max-age={HLS_SEGMENT_SECONDS * HLS_WINDOW}, immutable"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
+
+@app.errorhandler(TranscodeBusy)
+def transcode_busy(e):
+    return Response(
+        "All transcoders are busy, please retry shortly.\n",
+        status=503,
+        mimetype="text/plain",
+        headers={"Retry-After": str(TRANSCODE_RETRY_AFTER)}
+    )
 
-    ch = channels[idx]
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
+@app.route("/transcode/status")
+def transcode_status():
+    return jsonify(TRANSCODES.status())
+
+@app.route("/play-240p/<group>/<int:idx>")
+def play_240p_at(group, idx):
+    return play_240p_channel(channel_at(group, idx))
+
+@app.route("/play-240p/<channel_id>")
+def play_240p(channel_id):
+    return play_240p_channel(channel_or_404(channel_id))
+
+def play_240p_channel(ch):
     headers = {
         "Access-Control-Allow-Origin": "*",
         "Cache-Control": "no-cache"
     }
 
     return Response(
-        stream_with_context(proxy_video_240p(ch["url"])),
+        stream_with_context(proxy_video_240p(ch.url, ch.tvg_id)),
         mimetype="video/mp2t",
         headers=headers
     )
 
 @app.route("/watch-240p/<group>/<int:idx>")
-def watch_240p(group, idx):
-    if group not in PLAYLISTS:
-        abort(404)
+def watch_240p_at(group, idx):
+    return redirect(f"/watch-240p/{channel_at(group, idx).id}")
 
-    channels = get_channels(group)
-    if idx < 0 or idx >= len(channels):
-        abort(404)
+@app.route("/watch-240p/<channel_id>")
+def watch_240p(channel_id):
+    ch = channel_or_404(channel_id)
 
-    ch = channels[idx]
+    if LOWDATA_MODE == "abr":
+        url, mime = f"/hls-abr/{ch.id}/master.m3u8", "application/vnd.apple.mpegurl"
+    elif LOWDATA_MODE == "hls":
+        url, mime = f"/hls-240p/{ch.id}/index.m3u8", "application/vnd.apple.mpegurl"
+    else:
+        url, mime = f"/play-240p/{ch.id}", "video/mp2t"
 
     channel = {
-        "title": ch["title"] + " (240p)",
-        "url": f"/play-240p/{group}/{idx}",
-        "logo": ch.get("logo", "")
+        "title": ch.title + " (240p)",
+        "url": url,
+        "logo": ch.logo
     }
 
-    return render_template_string(
-        WATCH_HTML,
+    return render(
+        "watch",
         channel=channel,
-        mime_type="video/mp2t"
+        mime_type=mime
     )
 
 
@@ -785,22 +3141,469 @@ def watch_240p_direct():
     if not u:
         abort(404)
 
+    if LOWDATA_MODE == "abr":
+        url, mime = f"/hls-abr-direct/master.m3u8?u={quote(u, safe='')}", "application/vnd.apple.mpegurl"
+    elif LOWDATA_MODE == "hls":
+        url, mime = f"/hls-240p-direct/index.m3u8?u={quote(u, safe='')}", "application/vnd.apple.mpegurl"
+    else:
+        # ⚠️ IMPORTANT: source MUST be play-240p-direct
+        url, mime = f"/play-240p-direct?u={u}", "video/mp2t"
+
     channel = {
         "title": title + " (240p)",
-        # ⚠️ IMPORTANT: source MUST be play-240p-direct
-        "url": f"/play-240p-direct?u={u}",
+        "url": url,
         "logo": logo
     }
 
-    return render_template_string(
-        WATCH_HTML,
+    return render(
+        "watch",
         channel=channel,
-        mime_type="video/mp2t"
+        mime_type=mime
     )
 
+# ============================================================
+# JSON API (for apps; bodies serialized once per playlist version)
+# ============================================================
+API_FIELDS = {
+    "id": lambda ch: ch.id,
+    "title": lambda ch: ch.title,
+    "url": lambda ch: ch.url,
+    "logo": lambda ch: ch.logo,
+    "group": lambda ch: ch.group,
+    "tvg_id": lambda ch: ch.tvg_id,
+    "live": lambda ch: HEALTH[ch.url]["ok"] if ch.url in HEALTH else None,
+}
+API_DEFAULT_FIELDS = ("id", "title", "url", "logo", "group")
+API_SEARCH_LIMIT = 50
+API_SEARCH_MAX = 500
+
+def _api_fields():
+    raw = request.args.get("fields", "")
+    if not raw:
+        return API_DEFAULT_FIELDS
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(",") if f.strip()))
+    if not fields or any(f not in API_FIELDS for f in fields):
+        abort(400, description=f"fields must be a subset of {','.join(API_FIELDS)}")
+    return fields
+
+def _api_json(data) -> bytes:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+def _api_channels(channels, fields):
+    getters = [(f, API_FIELDS[f]) for f in fields]
+    return [{f: get(ch) for f, get in getters} for ch in channels]
+
+def _api_version(entry, fields, extra=""):
+    # health only matters when it is shown or used to filter/sort
+    return (entry["version"], PROBER.generation if extra or "live" in fields else 0)
+
+@app.route("/api/playlists")
+def api_playlists():
+    # only reports what is already loaded; never triggers a fetch
+    entries = [(name, CACHE.get(name)) for name in PLAYLISTS]
+    version = tuple((e["version"], e["time"]) if e else None for _, e in entries)
+    return cached_response(("api", "playlists"), version, lambda: _api_json({"playlists": [{
+        "name": name,
+        "url": PLAYLISTS[name],
+        "channels": len(e["channels"]) if e else None,
+        "fetched": int(e["time"]) if e else None,
+    } for name, e in entries]}), "application/json")
+
+@app.route("/api/list/<group>")
+def api_list(group):
+    if group not in PLAYLISTS:
+        abort(404)
+    fields = _api_fields()
+    entry = get_entry(group)
+    if entry is None:
+        abort(503)
+    channels = entry["channels"]
+    rows, extra = _list_rows(channels)
+    total = len(rows) if rows is not None else len(channels)
+    page, limit, pages = _page_args(total)
+
+    def body():
+        page_rows = _page_rows(channels, rows, (page - 1) * limit, limit)
+        return _api_json({
+            "group": group, "page": page, "pages": pages, "limit": limit, "total": total,
+            "channels": _api_channels((ch for _, ch in page_rows), fields),
+        })
+
+    return cached_response(
+        ("api-list", group, page, limit, fields, extra), _api_version(entry, fields, extra),
+        body, "application/json"
+    )
+
+@app.route("/api/list/<group>.m3u")
+def api_list_m3u(group):
+    # filtered re-export: ?q= narrows by search, ?live=1 / ?sort=health as on /list
+    if group not in PLAYLISTS:
+        abort(404)
+    entry = get_entry(group)
+    if entry is None:
+        abort(503)     # an empty 200 would make polling players drop every channel
+    channels = entry["channels"]
+    q = request.args.get("q", "").strip()
+    if q:
+        index = get_search_index(group)
+        channels = [index.channels[i] for i in index.search(q)] if index is not None else []
+    rows, _ = _list_rows(channels)
+    selected = (ch for _, ch in rows) if rows is not None else iter(channels)
+    return Response(
+        _buffered(write_m3u(selected)), mimetype="audio/x-mpegurl",
+        headers={"Content-Disposition": f'inline; filename="{group}.m3u"'}
+    )
+
+@app.route("/api/search")
+def api_search():
+    q = request.args.get("q", "").strip()
+    if not q:
+        abort(400, description="q is required")
+    fields = _api_fields()
+    limit = min(max(request.args.get("limit", API_SEARCH_LIMIT, type=int), 1), API_SEARCH_MAX)
+    entry = get_entry("all")
+    index = get_search_index("all")
+    if entry is None or index is None:
+        abort(503)
+
+    def body():
+        started = time.perf_counter()
+        found = index.search(q)
+        SEARCH_SECONDS.observe(time.perf_counter() - started)
+        return _api_json({
+            "query": q, "total": len(found),
+            "channels": _api_channels((index.channels[i] for i in found[:limit]), fields),
+        })
+
+    return cached_response(
+        (q.lower(), limit, fields), _api_version(entry, fields), body, "application/json",
+        cache=SEARCH_CACHE, max_items=SEARCH_CACHE_MAX
+    )
+
+# ============================================================
+# HLS passthrough proxy (manifest rewriting + shared segment cache)
+# ============================================================
+PROXY_HLS = os.environ.get("PROXY_HLS", "0") == "1"    # watch pages play .m3u8 channels through /proxy/hls
+SEGMENT_CACHE_BYTES = int(os.environ.get("SEGMENT_CACHE_BYTES", 128 * 1024 * 1024))
+SEGMENT_CACHE_TTL = 60                # segments are immutable; this only bounds how long we hold them
+MANIFEST_CACHE_TTL = 1                # live playlists change every target duration
+UPSTREAM_TIMEOUT = (5, 15)
+# proxied URLs carry an HMAC, so only channel URLs and what their manifests list can be fetched;
+# without PROXY_SECRET a key is generated once next to the playlist store and shared by all workers
+PROXY_SECRET = os.environ.get("PROXY_SECRET", "").encode()
+PROXY_KEY_FILE = os.path.join(os.path.dirname(PLAYLIST_STORE_DIR), "proxy.key")
+_URI_ATTR_RE = re.compile(r'URI="([^"]+)"')
+
+UPSTREAM = requests.Session()
+UPSTREAM.headers["User-Agent"] = "Mozilla/5.0 (restream)"
+_adapter = requests.adapters.HTTPAdapter(pool_connections=64, pool_maxsize=64)
+UPSTREAM.mount("http://", _adapter)
+UPSTREAM.mount("https://", _adapter)
+
+SEGMENT_CACHE_LOOKUPS = Counter("restream_segment_cache_lookups_total", "Proxy cache lookups", ("kind", "result"))
+
+class SegmentCache:
+    # byte-bounded LRU with TTL; concurrent misses for one URL share a single upstream fetch
+    def __init__(self, max_bytes: int, ttl: float, kind: str):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.kind = kind
+        self.items = OrderedDict()      # url -> (expires, value, size)
+        self.size = 0
+        self.inflight = {}              # url -> Event
+        self.lock = threading.Lock()
+
+    def _lookup(self, url):
+        item = self.items.get(url)
+        if item is None:
+            return None
+        if item[0] < time.time():
+            del self.items[url]
+            self.size -= item[2]
+            return None
+        self.items.move_to_end(url)
+        return item[1]
+
+    def _store(self, url, value, size):
+        if size > self.max_bytes // 4:
+            return
+        old = self.items.pop(url, None)
+        if old is not None:
+            self.size -= old[2]
+        self.items[url] = (time.time() + self.ttl, value, size)
+        self.size += size
+        while self.size > self.max_bytes and self.items:
+            _, (_, _, dropped) = self.items.popitem(last=False)
+            self.size -= dropped
+
+    def get(self, url, fetch):
+        with self.lock:
+            value = self._lookup(url)
+            if value is not None:
+                SEGMENT_CACHE_LOOKUPS.inc(self.kind, "hit")
+                return value
+            event = self.inflight.get(url)
+            leader = event is None
+            if leader:
+                event = self.inflight[url] = threading.Event()
+        if not leader:
+            SEGMENT_CACHE_LOOKUPS.inc(self.kind, "shared")
+            event.wait(UPSTREAM_TIMEOUT[0] + UPSTREAM_TIMEOUT[1])
+            with self.lock:
+                return self._lookup(url)
+        SEGMENT_CACHE_LOOKUPS.inc(self.kind, "miss")
+        try:
+            value, size = fetch(url)
+            with self.lock:
+                self._store(url, value, size)
+            return value
+        finally:
+            with self.lock:
+                self.inflight.pop(url, None)
+            event.set()
+
+SEGMENTS = SegmentCache(SEGMENT_CACHE_BYTES, SEGMENT_CACHE_TTL, "segment")
+MANIFESTS = SegmentCache(8 * 1024 * 1024, MANIFEST_CACHE_TTL, "manifest")
+
+class UpstreamTooLarge(requests.RequestException):
+    pass
+
+def proxy_key() -> bytes:
+    global PROXY_SECRET
+    if not PROXY_SECRET:
+        os.makedirs(os.path.dirname(PROXY_KEY_FILE), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(PROXY_KEY_FILE))
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32).hex().encode())
+        try:
+            os.link(tmp, PROXY_KEY_FILE)     # first worker wins; the rest read its key
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+        with open(PROXY_KEY_FILE, "rb") as f:
+            PROXY_SECRET = f.read().strip()
+    return PROXY_SECRET
+
+def sign_url(url: str) -> str:
+    return hmac.new(proxy_key(), url.encode(), hashlib.sha256).hexdigest()[:32]
+
+def player_source(url: str):
+    if PROXY_HLS and ".m3u8" in url and url.startswith(("http://", "https://")):
+        return _proxied(url, True)
+    return None
+
+def _proxied(url: str, playlist: bool):
+    return "%s?u=%s&s=%s" % ("/proxy/hls" if playlist else "/proxy/seg", quote(url, safe=""), sign_url(url))
+
+def rewrite_manifest(text: str, base_url: str) -> str:
+    # in a master playlist the URI lines are variant playlists, otherwise media segments
+    master = "#EXT-X-STREAM-INF" in text
+    out = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#"):
+            if 'URI="' in line:
+                playlist = line.startswith(("#EXT-X-MEDIA:", "#EXT-X-I-FRAME-STREAM-INF:"))
+                line = _URI_ATTR_RE.sub(
+                    lambda m: 'URI="%s"' % _proxied(urljoin(base_url, m.group(1)), playlist), line)
+            out.append(line)
+        else:
+            out.append(_proxied(urljoin(base_url, line), master))
+    return "\n".join(out) + "\n"
+
+def _read_limited(resp, limit: int) -> bytes:
+    # stop as soon as the body outgrows what the cache would keep anyway
+    if int(resp.headers.get("Content-Length") or 0) > limit:
+        raise UpstreamTooLarge("Content-Length over %d bytes" % limit)
+    buf, n = [], 0
+    for chunk in resp.iter_content(64 * 1024):
+        n += len(chunk)
+        if n > limit:
+            raise UpstreamTooLarge("body over %d bytes" % limit)
+        buf.append(chunk)
+    return b"".join(buf)
+
+def _fetch_manifest(url: str):
+    with UPSTREAM.get(url, timeout=UPSTREAM_TIMEOUT, stream=True) as resp:
+        resp.raise_for_status()
+        text = _read_limited(resp, MANIFESTS.max_bytes // 4).decode("utf-8", "replace")
+        # relative URIs resolve against where we ended up after redirects
+        body = rewrite_manifest(text, resp.url).encode()
+    return body, len(body)
+
+def _fetch_segment(url: str):
+    with UPSTREAM.get(url, timeout=UPSTREAM_TIMEOUT, stream=True) as resp:
+        resp.raise_for_status()
+        body = _read_limited(resp, SEGMENTS.max_bytes // 4)
+    return (resp.headers.get("Content-Type") or "video/mp2t", body), len(body)
+
+def _upstream_arg():
+    u = request.args.get("u", "")
+    if not u.startswith(("http://", "https://")):
+        abort(400)
+    if not hmac.compare_digest(request.args.get("s", ""), sign_url(u)):
+        abort(403)
+    return u
+
+@app.route("/proxy/hls")
+def proxy_hls():
+    u = _upstream_arg()
+    try:
+        body = MANIFESTS.get(u, _fetch_manifest)
+    except requests.RequestException as e:
+        logging.warning("[proxy] manifest failed %s: %s", u, e)
+        abort(502)
+    if body is None:
+        abort(504)
+    return Response(body, mimetype="application/vnd.apple.mpegurl", headers={
+        "Access-Control-Allow-Origin": "*",
+        "Cache-Control": "no-cache"
+    })
+
+@app.route("/proxy/seg")
+def proxy_segment():
+    u = _upstream_arg()
+    try:
+        item = SEGMENTS.get(u, _fetch_segment)
+    except requests.RequestException as e:
+        logging.warning("[proxy] segment failed %s: %s", u, e)
+        abort(502)
+    if item is None:
+        abort(504)
+    content_type, body = item
+    return Response(body, mimetype=content_type, headers={
+        "Access-Control-Allow-Origin": "*",
+        "Cache-Control": f"public, max-age={SEGMENT_CACHE_TTL}"
+    })
+
+# ============================================================
+# ASGI streaming mode (python restream.py --asgi)
+# ============================================================
+# /play-240p* viewers are served straight from the event loop: one asyncio
+# ffmpeg pipe per session and one coroutine per viewer instead of one thread
+# each. Everything else goes through the Flask app on a small thread pool.
+ASGI_WSGI_WORKERS = int(os.environ.get("ASGI_WSGI_WORKERS", "16"))
+ASGI_SEND_TIMEOUT = 30                # drop viewers whose socket hasn't drained for this long
+PLAY_240P_PATH = re.compile(r"^/play-240p/([^/]+)(?:/(\d+))?$")    # /<channel_id> or old /<group>/<idx>
+
+WSGI_APP = None
+
+def wsgi_fallback():
+    global WSGI_APP
+    if WSGI_APP is None:
+        from a2wsgi import WSGIMiddleware
+        WSGI_APP = WSGIMiddleware(app, workers=ASGI_WSGI_WORKERS)
+    return WSGI_APP
+
+async def proxy_video_240p_async(source_url: str, tvg_id=""):
+    loop = asyncio.get_running_loop()
+    # the alternates lookup and admission may block, so they run on a worker thread
+    session = await asyncio.to_thread(
+        lambda: TRANSCODES.acquire((source_url, "240p"), ts_240p_factory(source_url, tvg_id, loop))
+    )
+    return session.subscribe()
+
+async def asgi_source(scope):
+    # (source URL, tvg_id) for the request, or (None, "")
+    if scope["path"] == "/play-240p-direct":
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        return (query.get("u") or [None])[0], ""
+    match = PLAY_240P_PATH.match(scope["path"])
+    if match.group(2) is None:
+        ch = await asyncio.to_thread(find_channel, match.group(1))
+        return (ch.url, ch.tvg_id) if ch is not None else (None, "")
+    group, idx = match.group(1), int(match.group(2))
+    if group not in PLAYLISTS:
+        return None, ""
+    channels = await asyncio.to_thread(get_channels, group)
+    if idx >= len(channels):
+        return None, ""
+    return channels[idx].url, channels[idx].tvg_id
+
+async def asgi_text(send, status, text, headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain")] + list(headers),
+    })
+    await send({"type": "http.response.body", "body": text.encode()})
+
+async def asgi_play_240p(scope, receive, send):
+    source, tvg_id = await asgi_source(scope)
+    if not source:
+        return await asgi_text(send, 404, "Not Found\n")
+    try:
+        stream = await proxy_video_240p_async(source, tvg_id)
+    except TranscodeBusy:
+        return await asgi_text(send, 503, "All transcoders are busy, please retry shortly.\n",
+                               [(b"retry-after", str(TRANSCODE_RETRY_AFTER).encode())])
+
+    async def relay():
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"video/mp2t"),
+                (b"access-control-allow-origin", b"*"),
+                (b"cache-control", b"no-cache"),
+            ],
+        })
+        async for data in stream:
+            # send() waits for the socket to drain, so a slow phone only holds back its own cursor
+            await asyncio.wait_for(
+                send({"type": "http.response.body", "body": data, "more_body": True}),
+                ASGI_SEND_TIMEOUT
+            )
+        await send({"type": "http.response.body", "body": b""})
+
+    async def disconnected():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(relay()), asyncio.ensure_future(disconnected())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await stream.aclose()
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                start_prewarm(asyncio.get_running_loop())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    if scope["path"] == "/play-240p-direct" or PLAY_240P_PATH.match(scope["path"]):
+        return await asgi_play_240p(scope, receive, send)
+    try:
+        wsgi = wsgi_fallback()
+    except ImportError:
+        return await asgi_text(send, 500, "ASGI mode needs a2wsgi installed\n")
+    await wsgi(scope, receive, send)
+
 # ============================================================
 # Entry
 # ============================================================
 if __name__ == "__main__":
     print("Running IPTV Restream on http://0.0.0.0:8000")
-    app.run(host="0.0.0.0", port=8000, debug=False, threaded=True)
+    if "--asgi" in sys.argv:
+        try:
+            import uvicorn
+            wsgi_fallback()
+        except ImportError:
+            sys.exit("--asgi needs uvicorn and a2wsgi installed")
+        uvicorn.run(asgi_app, host="0.0.0.0", port=8000, log_level="warning")
+    else:
+        start_prewarm()
+        app.run(host="0.0.0.0", port=8000, debug=False, threaded=True)
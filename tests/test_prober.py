@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+import restream
+from bench.stub import StubServer
+
+
+def test_probe_many_against_stub():
+    restream.HEALTH.clear()
+    with StubServer() as stub:
+        urls = {
+            "ts": stub.put("/live/a.ts", b"\x47" + b"\xff" * 187, "video/mp2t"),
+            "m3u8": stub.put("/live/b.m3u8", "#EXTM3U\n#EXTINF:4,\nseg.ts\n", "application/vnd.apple.mpegurl"),
+            "bad_m3u8": stub.put("/live/c.m3u8", "<html>not a playlist</html>", "text/html"),
+            "missing": stub.base + "/live/gone.ts",
+        }
+        prober = restream.StreamProber(concurrency=2, timeout=3)
+        results = asyncio.run(prober.probe_many(list(urls.values())))
+
+    assert results[urls["ts"]]["ok"]
+    assert results[urls["ts"]]["status"] == 200
+    assert results[urls["ts"]]["ttfb"] is not None
+    assert results[urls["m3u8"]]["ok"]
+    assert not results[urls["bad_m3u8"]]["ok"]
+    assert not results[urls["missing"]]["ok"]
+    assert results[urls["missing"]]["status"] == 404
+    # results land in HEALTH, and the first sighting of each URL counts as a change
+    assert restream.HEALTH[urls["ts"]] is results[urls["ts"]]
+    assert prober.dirty